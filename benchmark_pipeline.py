@@ -0,0 +1,235 @@
+"""
+Reproducible benchmark for the recognition pipeline.
+
+Draws deterministic synthetic coin images (textured discs on noisy backgrounds), then times every
+pipeline stage, end-to-end run_recognition_pipeline and model loading through model_loader. Results
+are written as JSON together with the library versions. When models_final is missing (or with
+--stand-in), small stand-in forests are trained on the fly, so neither the dataset nor the trained
+models are needed. Compare a run against a saved baseline to catch regressions after upgrading
+OpenCV, scikit-image, scikit-learn or NumPy.
+
+Usage:
+    python benchmark_pipeline.py -o baseline.json
+    python benchmark_pipeline.py -o upgraded.json --baseline baseline.json [--threshold 0.15]
+    python benchmark_pipeline.py --compare upgraded.json --baseline baseline.json
+"""
+import os
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from image_processing_pipeline import (DEFAULT_FEATURE_NAMES, compile_feature_layout, extract_color_features, extract_feature_vector,
+                                       extract_hog_features, extract_hu_moments, extract_lbp_features, extract_shape_features,
+                                       predict_feature_probabilities, preprocess_denoise_normalize, run_recognition_pipeline,
+                                       segment_hough_circle)
+import model_loader
+from compact_models import export_compact_models, load_compact_assets
+from segmentation_engine import PyramidHoughSegmenter
+
+STAND_IN_TYPES = ['10c', '20c', '50c', 'R1', 'R2', 'R5']
+STAND_IN_SIDES = ['Heads', 'Tails']
+
+
+def synthetic_coin_image(rng, height=480, width=640):
+    """A BGR frame with one textured disc (rim, relief rings and strokes) on a noisy, blurred background."""
+    image = cv2.GaussianBlur(rng.integers(40, 90, (height, width, 3)).astype(np.uint8), (5, 5), 0)
+    radius = int(rng.integers(120, 200))
+    cx, cy = int(rng.integers(radius + 10, width - radius - 10)), int(rng.integers(radius + 10, height - radius - 10))
+    color = tuple(int(v) for v in rng.integers(120, 230, 3))
+    relief = tuple(int(v * 0.7) for v in color)
+    cv2.circle(image, (cx, cy), radius, color, -1)
+    cv2.circle(image, (cx, cy), radius - 8, relief, 3)
+    for _ in range(30):
+        angle, dist = rng.uniform(0, 2 * np.pi), rng.uniform(0, radius * 0.8)
+        cv2.circle(image, (int(cx + dist * np.cos(angle)), int(cy + dist * np.sin(angle))), int(rng.integers(3, 15)), relief, 2)
+    for _ in range(8):
+        x0, y0 = rng.integers(-radius // 2, radius // 2, 2)
+        x1, y1 = rng.integers(-radius // 2, radius // 2, 2)
+        cv2.line(image, (cx + int(x0), cy + int(y0)), (cx + int(x1), cy + int(y1)), relief, 2)
+    return image
+
+
+def synthetic_images(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [synthetic_coin_image(rng) for _ in range(count)]
+
+
+def build_stand_in_models(model_dir, feature_names=DEFAULT_FEATURE_NAMES, seed=0):
+    """Writes a scaler, two small random forests and feature_names.json to model_dir in the models_final layout."""
+    import joblib
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.preprocessing import StandardScaler
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(300, len(feature_names)))
+    scaler = StandardScaler().fit(X)
+    X_scaled = scaler.transform(X)
+    type_clf = RandomForestClassifier(n_estimators=30, random_state=seed).fit(X_scaled, rng.choice(STAND_IN_TYPES, len(X)))
+    side_clf = RandomForestClassifier(n_estimators=20, random_state=seed + 1).fit(X_scaled, rng.choice(STAND_IN_SIDES, len(X)))
+    os.makedirs(model_dir, exist_ok=True)
+    joblib.dump(scaler, os.path.join(model_dir, model_loader.SCALER_FILENAME))
+    joblib.dump(type_clf, os.path.join(model_dir, model_loader.TYPE_MODEL_FILENAME))
+    joblib.dump(side_clf, os.path.join(model_dir, model_loader.SIDE_MODEL_FILENAME))
+    with open(os.path.join(model_dir, model_loader.FEATURE_NAMES_FILENAME), 'w') as f:
+        json.dump(list(feature_names), f)
+    return model_dir
+
+
+def time_calls(fn, inputs, repeats):
+    """Calls fn(*args) for every args tuple in inputs, once as warm-up and then `repeats` times; returns the timed calls in ms."""
+    for args in inputs[:1]: fn(*args)
+    samples = []
+    for _ in range(repeats):
+        for args in inputs:
+            start = time.perf_counter()
+            fn(*args)
+            samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def summarize_samples(samples):
+    values = np.asarray(samples)
+    return {'median_ms': float(np.median(values)), 'p95_ms': float(np.percentile(values, 95)), 'min_ms': float(values.min()),
+            'mean_ms': float(values.mean()), 'calls': int(values.size)}
+
+
+def run_benchmarks(images, assets, model_dir, repeats=5):
+    """Times each stage over the synthetic images and returns {case: summary}."""
+    scaler, feature_names, type_clf, side_clf = assets
+    layout = compile_feature_layout(feature_names)
+    resized = [cv2.resize(img, (300, 300), interpolation=cv2.INTER_AREA) for img in images]
+    preprocessed = [preprocess_denoise_normalize(img) for img in resized]
+    searched = [segment_hough_circle(g) for g in preprocessed]
+    segmented = [(seg, mask, bgr) for (seg, mask, circles), bgr in zip(searched, resized) if circles is not None]
+    segmenter = PyramidHoughSegmenter()
+    if not segmented:
+        raise RuntimeError("No coin detected in any synthetic image.")
+    feature_matrix = np.array([extract_feature_vector(seg, mask, layout, bgr) for seg, mask, bgr in segmented])
+    compact_tmp = tempfile.TemporaryDirectory()
+    compact_dir = export_compact_models(*assets, compact_tmp.name)
+    compact_scaler, _, compact_type, compact_side = load_compact_assets(compact_dir)
+
+    cases = {
+        'resize': (lambda img: cv2.resize(img, (300, 300), interpolation=cv2.INTER_AREA), [(img,) for img in images]),
+        'preprocess_accurate': (lambda img: preprocess_denoise_normalize(img, 'accurate'), [(img,) for img in resized]),
+        'preprocess_fast': (lambda img: preprocess_denoise_normalize(img, 'fast'), [(img,) for img in resized]),
+        'segment': (segment_hough_circle, [(g,) for g in preprocessed]),
+        'segment_pyramid': (segmenter.segment, [(g,) for g in preprocessed]),
+        'segment_tracked': (segmenter.segment, [(g, circles[0, 0]) for g, (_, _, circles) in zip(preprocessed, searched) if circles is not None]),
+        'features_shape': (extract_shape_features, [(seg, mask) for seg, mask, _ in segmented]),
+        'features_hu': (extract_hu_moments, [(seg, mask) for seg, mask, _ in segmented]),
+        'features_lbp': (extract_lbp_features, [(seg, mask) for seg, mask, _ in segmented]),
+        'features_hog': (extract_hog_features, [(seg, mask) for seg, mask, _ in segmented]),
+        'features_color': (extract_color_features, [(bgr, mask) for _, mask, bgr in segmented]),
+        'features_vector': (lambda seg, mask, bgr: extract_feature_vector(seg, mask, layout, bgr), segmented),
+        'classify_single': (lambda row: predict_feature_probabilities(row, scaler, type_clf, side_clf), [(row[None],) for row in feature_matrix]),
+        'classify_batch': (lambda matrix: predict_feature_probabilities(matrix, scaler, type_clf, side_clf), [(feature_matrix,)]),
+        'classify_single_sklearn': (lambda row: (type_clf.predict_proba(scaler.transform(row)), side_clf.predict_proba(scaler.transform(row))), [(row[None],) for row in feature_matrix]),
+        'classify_single_compact': (lambda row: predict_feature_probabilities(row, compact_scaler, compact_type, compact_side), [(row[None],) for row in feature_matrix]),
+        'classify_batch_compact': (lambda matrix: predict_feature_probabilities(matrix, compact_scaler, compact_type, compact_side), [(feature_matrix,)]),
+        'end_to_end_accurate': (lambda img: run_recognition_pipeline(img, scaler, type_clf, side_clf, feature_names, profile='accurate'), [(img,) for img in images]),
+        'end_to_end_fast': (lambda img: run_recognition_pipeline(img, scaler, type_clf, side_clf, feature_names, profile='fast'), [(img,) for img in images]),
+        'model_load': (lambda: model_loader.load_prediction_assets(model_dir, prefer_compact=False), [()]),
+        'model_load_compact': (lambda: load_compact_assets(compact_dir), [()]),
+    }
+    results = {}
+    with compact_tmp:
+        for name, (fn, inputs) in cases.items():
+            results[name] = summarize_samples(time_calls(fn, inputs, repeats))
+            print(f"  {name:<24} median {results[name]['median_ms']:9.2f} ms  p95 {results[name]['p95_ms']:9.2f} ms", file=sys.stderr)
+    return results, len(segmented)
+
+
+def environment_info():
+    import joblib, skimage, sklearn
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(),
+            'cpu_count': os.cpu_count(), 'opencv': cv2.__version__, 'opencv_threads': cv2.getNumThreads(), 'numpy': np.__version__,
+            'scikit_image': skimage.__version__, 'scikit_learn': sklearn.__version__, 'joblib': joblib.__version__}
+
+
+def compare_results(current, baseline, threshold=0.15, min_delta_ms=0.5):
+    """
+    Prints a per-case comparison of median latencies and returns the regressed case names. A case
+    regresses when its median is more than `threshold` (relative) and `min_delta_ms` (absolute) slower.
+    """
+    for key in ('images', 'seed', 'models'):
+        if current['config'].get(key) != baseline['config'].get(key):
+            print(f"Warning: {key} differs ({current['config'].get(key)} vs baseline {baseline['config'].get(key)}); results may not be comparable.")
+    changed_versions = {k: (baseline['environment'].get(k), v) for k, v in current['environment'].items() if baseline['environment'].get(k) != v}
+    for key, (old, new) in changed_versions.items():
+        print(f"Environment {key}: {old} -> {new}")
+
+    regressions = []
+    print(f"{'case':<24} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, stats in current['cases'].items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            print(f"{name:<24} {'-':>10} {stats['median_ms']:10.2f}      new")
+            continue
+        ratio = stats['median_ms'] / base['median_ms'] if base['median_ms'] > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + threshold and stats['median_ms'] - base['median_ms'] > min_delta_ms:
+            flag = '  REGRESSION'; regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print(f"{name:<24} {base['median_ms']:10.2f} {stats['median_ms']:10.2f} {ratio - 1:+8.1%}{flag}")
+    for name in baseline['cases'].keys() - current['cases'].keys():
+        print(f"{name:<24} missing from the current run")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the coin recognition pipeline on synthetic images.")
+    parser.add_argument('-o', '--output', help="Write results as JSON to this file.")
+    parser.add_argument('--images', type=int, default=12, help="Number of synthetic images (default 12).")
+    parser.add_argument('--repeats', type=int, default=5, help="Timed passes over the images per case (default 5).")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic images and stand-in models (default 0).")
+    parser.add_argument('--stand-in', action='store_true', help="Always use stand-in models, even when models_final exists.")
+    parser.add_argument('--baseline', help="Saved results to compare against; exits with status 2 on regressions.")
+    parser.add_argument('--compare', metavar='RESULTS', help="Compare saved RESULTS against --baseline without running the benchmark.")
+    parser.add_argument('--threshold', type=float, default=0.15, help="Relative slowdown of the median that counts as a regression (default 0.15).")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        if not args.baseline: parser.error("--compare requires --baseline")
+        with open(args.compare) as f: current = json.load(f)
+    else:
+        cv2.setRNGSeed(args.seed)
+        with tempfile.TemporaryDirectory() as tmp:
+            use_stand_in = args.stand_in or not model_loader.MODEL_DIR.exists()
+            model_dir = build_stand_in_models(os.path.join(tmp, 'models'), seed=args.seed) if use_stand_in else model_loader.MODEL_DIR
+            assets = model_loader.load_prediction_assets(model_dir, prefer_compact=False)
+            if not all(a is not None for a in assets):
+                print("Prediction assets failed to load.", file=sys.stderr)
+                return 1
+            print(f"Benchmarking {args.images} synthetic images x {args.repeats} repeats ({'stand-in' if use_stand_in else 'models_final'} models)...", file=sys.stderr)
+            cases, detected = run_benchmarks(synthetic_images(args.images, args.seed), assets, model_dir, args.repeats)
+        current = {'timestamp': time.time(), 'environment': environment_info(),
+                   'config': {'images': args.images, 'detected': detected, 'repeats': args.repeats, 'seed': args.seed,
+                              'models': 'stand-in' if use_stand_in else 'models_final'},
+                   'cases': cases}
+        if args.output:
+            with open(args.output, 'w') as f: json.dump(current, f, indent=2)
+            print(f"Results written to {args.output}", file=sys.stderr)
+        elif not args.baseline:
+            print(json.dumps(current, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+        regressions = compare_results(current, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            return 2
+        print("No regressions.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import deque
+import cv2
+from kivy.logger import Logger
+
+
+class ThreadedCapture:
+    """
+    Wraps cv2.VideoCapture and reads frames continuously on a background thread into a small ring buffer,
+    so callers never block on network I/O (e.g. DroidCam 'http://<ip>:4747/video' streams).
+
+    Every frame read is a freshly allocated array that the reader never writes to again, so the newest frame
+    is handed out without a copy. If the stream drops, the reader reconnects automatically. The reader
+    thread alone touches the VideoCapture and releases it on exit; release() only asks it to stop,
+    so a reader blocked in grab() on a network stream never races a release from another thread.
+    """
+    def __init__(self, source, buffer_size=4, reconnect_delay=1.0, max_failed_reads=30, failed_read_delay=0.01):
+        self.source = source
+        self.reconnect_delay = reconnect_delay
+        self.max_failed_reads = max_failed_reads
+        self.failed_read_delay = failed_read_delay
+        self._ring = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_consumed_seq = 0
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.reconnects = 0
+        self.last_grab_time = 0.0
+        self.last_decode_time = 0.0
+        self._decode_time_total = 0.0
+        self.last_frame_age = 0.0
+
+    def open(self):
+        """Opens the source and starts the reader thread. Returns False if the source cannot be opened."""
+        capture = cv2.VideoCapture(self.source)
+        if not capture.isOpened():
+            capture.release()
+            return False
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._reader_loop, args=(capture,), name=f"ThreadedCapture({self.source})", daemon=True)
+        self._thread.start()
+        return True
+
+    def isOpened(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def latest(self):
+        """Returns (frame, seq) for the newest frame without copying it, or (None, 0) if none has arrived yet."""
+        with self._lock:
+            if not self._ring: return None, 0
+            seq, timestamp, frame = self._ring[-1]
+            if seq > self._last_consumed_seq:
+                self.frames_dropped += seq - self._last_consumed_seq - 1
+                self._last_consumed_seq = seq
+            self.last_frame_age = time.perf_counter() - timestamp
+            return frame, seq
+
+    def read(self):
+        """cv2.VideoCapture-compatible read() that returns the newest buffered frame."""
+        frame, _ = self.latest()
+        return frame is not None, frame
+
+    def stats(self):
+        """Counters for frames read and dropped, reconnects, grab/decode time and the age of the last handed-out frame."""
+        with self._lock:
+            return {'frames_read': self.frames_read, 'frames_dropped': self.frames_dropped, 'reconnects': self.reconnects,
+                    'last_grab_ms': self.last_grab_time * 1000, 'last_decode_ms': self.last_decode_time * 1000,
+                    'avg_decode_ms': (self._decode_time_total / self.frames_read * 1000) if self.frames_read else 0.0,
+                    'last_frame_age_ms': self.last_frame_age * 1000}
+
+    def release(self):
+        """Stops the reader thread, which releases the capture itself, and waits briefly for it to finish."""
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread(): self._thread.join(timeout=2.0)
+        self._thread = None
+
+    def _reconnect(self, capture):
+        """Reader thread only: replaces a dropped capture. Returns the new capture, or None once release() was called."""
+        Logger.warning(f"Capture: Stream '{self.source}' dropped, reconnecting...")
+        capture.release()
+        while not self._stop_event.wait(self.reconnect_delay):
+            capture = cv2.VideoCapture(self.source)
+            if capture.isOpened():
+                self.reconnects += 1
+                Logger.info(f"Capture: Reconnected to '{self.source}'.")
+                return capture
+            capture.release()
+        return None
+
+    def _reader_loop(self, capture):
+        failed_reads = 0
+        try:
+            while not self._stop_event.is_set():
+                start = time.perf_counter()
+                grabbed = capture.grab()
+                grabbed_at = time.perf_counter()
+                frame = capture.retrieve()[1] if grabbed else None
+                if frame is None:
+                    failed_reads += 1
+                    if failed_reads < self.max_failed_reads:
+                        self._stop_event.wait(self.failed_read_delay)
+                        continue
+                    capture = self._reconnect(capture)
+                    if capture is None: return
+                    failed_reads = 0
+                    continue
+                failed_reads = 0
+                decode_time = time.perf_counter() - grabbed_at
+                with self._lock:
+                    self.frames_read += 1
+                    self.last_grab_time = grabbed_at - start
+                    self.last_decode_time = decode_time
+                    self._decode_time_total += decode_time
+                    self._ring.append((self.frames_read, grabbed_at, frame))
+        finally:
+            if capture is not None: capture.release()
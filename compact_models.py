@@ -0,0 +1,247 @@
+"""
+Compact, memory-mapped model artifacts.
+
+export_compact_models() flattens the fitted StandardScaler and both random forests into plain .npy
+arrays (one set of node arrays per forest) plus a manifest.json. load_compact_assets() memory-maps them
+back, so start-up costs a few file opens instead of unpickling every tree. CompactScaler and
+CompactForest reproduce StandardScaler.transform and RandomForestClassifier.predict_proba bit for bit,
+so they can be passed to the pipeline in place of the sklearn objects.
+
+Usage:
+    python compact_models.py [--model-dir models_final] [--output models_final/compact]
+"""
+import os
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+COMPACT_FORMAT_VERSION = 2  # 2: value holds predict_proba's per-node probabilities exactly (1 re-normalized them)
+MANIFEST_FILENAME = 'manifest.json'
+_FOREST_ARRAYS = ('left', 'right', 'feature', 'threshold', 'value', 'roots', 'classes')
+
+
+class CompactScaler:
+    """StandardScaler.transform on memory-mapped mean/scale arrays, with the same in-place float arithmetic."""
+    def __init__(self, mean, scale, n_features):
+        self.mean_, self.scale_ = mean, scale
+        self.n_features_in_ = n_features
+
+    def transform(self, X):
+        X = np.asarray(X)
+        X = np.array(X, dtype=X.dtype if X.dtype in (np.float32, np.float64) else np.float64)  # Copy, like sklearn's transform
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has shape {X.shape}, but CompactScaler is expecting {self.n_features_in_} features.")
+        if self.mean_ is not None: X -= self.mean_
+        if self.scale_ is not None: X /= self.scale_
+        return X
+
+
+class CompactForest:
+    """
+    Random forest classifier over flattened node arrays: all trees concatenated, child indices global,
+    -1 marking a leaf, and value holding each node's class probabilities as the tree's predict_proba
+    returns them. predict_proba matches sklearn exactly: inputs are cast to float32 like sklearn's trees,
+    and the per-tree probabilities are summed in tree order before dividing by the number of trees.
+    """
+    def __init__(self, left, right, feature, threshold, value, roots, classes, n_features=None):
+        self.left, self.right, self.feature, self.threshold, self.value = left, right, feature, threshold, value
+        self.roots = roots
+        self.classes_ = classes
+        self.n_classes_ = len(classes)
+        self.n_estimators = len(roots)
+        if n_features is not None: self.n_features_in_ = n_features
+
+    def apply(self, X):
+        """(n_samples, n_trees) array with the global index of the leaf each sample reaches in each tree."""
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(X.shape[0])
+        leaves = np.empty((X.shape[0], self.n_estimators), dtype=np.intp)
+        for t, root in enumerate(self.roots):
+            node = np.full(X.shape[0], root, dtype=np.intp)
+            while True:
+                left = self.left[node]
+                internal = left >= 0
+                if not internal.any(): break
+                go_left = X[rows, self.feature[node]] <= self.threshold[node]
+                node = np.where(internal, np.where(go_left, left, self.right[node]), node)
+            leaves[:, t] = node
+        return leaves
+
+    def predict_proba(self, X):
+        leaves = self.apply(X)
+        proba = np.zeros((leaves.shape[0], self.n_classes_))
+        for t in range(self.n_estimators):
+            proba += self.value[leaves[:, t]]
+        proba /= self.n_estimators
+        return proba
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+
+def _node_probabilities(tree, n_classes):
+    """Per-node class probabilities exactly as the installed scikit-learn's DecisionTreeClassifier.predict_proba returns them."""
+    from sklearn import __version__ as sklearn_version
+    from sklearn.utils.fixes import parse_version
+    value = tree.value[:, 0, :n_classes].copy()
+    # From 1.4 tree_.value already holds class fractions and predict_proba returns them as-is; dividing
+    # them again moves some probabilities by an ulp. Before 1.4 it held weighted counts that predict_proba normalized.
+    if parse_version(sklearn_version) < parse_version('1.4'):
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        value /= normalizer
+    return value
+
+
+def flatten_forest(forest):
+    """Returns the node arrays of a fitted RandomForestClassifier as a dict of numpy arrays."""
+    if getattr(forest, 'n_outputs_', 1) != 1:
+        raise ValueError("Only single-output forests can be exported.")
+    n_classes = int(forest.n_classes_)
+    lefts, rights, features, thresholds, values, roots = [], [], [], [], [], []
+    offset = 0
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        is_leaf = tree.children_left < 0
+        lefts.append(np.where(is_leaf, -1, tree.children_left + offset))
+        rights.append(np.where(is_leaf, -1, tree.children_right + offset))
+        features.append(np.where(is_leaf, 0, tree.feature))
+        thresholds.append(tree.threshold)
+        values.append(_node_probabilities(tree, n_classes))
+        roots.append(offset)
+        offset += tree.node_count
+    classes = np.asarray(forest.classes_)
+    if classes.dtype == object: classes = classes.astype(str)
+    return {'left': np.concatenate(lefts).astype(np.int64), 'right': np.concatenate(rights).astype(np.int64),
+            'feature': np.concatenate(features).astype(np.int64), 'threshold': np.concatenate(thresholds).astype(np.float64),
+            'value': np.ascontiguousarray(np.concatenate(values), dtype=np.float64), 'roots': np.asarray(roots, dtype=np.int64),
+            'classes': classes}
+
+
+def source_fingerprint(model_dir, filenames):
+    """{filename: {'size', 'mtime_ns'}} of the source files, used to detect artifacts exported from older models."""
+    fingerprint = {}
+    for name in filenames:
+        stat = (Path(model_dir) / name).stat()
+        fingerprint[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return fingerprint
+
+
+def export_compact_models(scaler, feature_names, type_clf, side_clf, output_dir, sources=None):
+    """Writes the scaler and both forests as .npy arrays plus manifest.json into output_dir."""
+    import sklearn
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    arrays = {}
+    # sklearn still fits mean_ with with_mean=False, but transform then leaves it out, so the export must too
+    if getattr(scaler, 'with_mean', True) and getattr(scaler, 'mean_', None) is not None:
+        arrays['scaler_mean'] = np.asarray(scaler.mean_, dtype=np.float64)
+    if getattr(scaler, 'with_std', True) and getattr(scaler, 'scale_', None) is not None:
+        arrays['scaler_scale'] = np.asarray(scaler.scale_, dtype=np.float64)
+    forests = {}
+    for prefix, forest in (('type', type_clf), ('side', side_clf)):
+        flat = flatten_forest(forest)
+        arrays.update({f'{prefix}_{name}': array for name, array in flat.items()})
+        forests[prefix] = {'n_estimators': len(flat['roots']), 'n_nodes': len(flat['left']), 'n_classes': len(flat['classes'])}
+    for name, array in arrays.items():
+        np.save(output_dir / f'{name}.npy', array, allow_pickle=False)
+    manifest = {'format': COMPACT_FORMAT_VERSION, 'sklearn_version': sklearn.__version__, 'n_features': int(scaler.n_features_in_),
+                'feature_names': list(feature_names), 'forests': forests, 'sources': sources or {}}
+    with open(output_dir / MANIFEST_FILENAME, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return output_dir
+
+
+def load_compact_assets(compact_dir, sources=None):
+    """
+    Memory-maps exported artifacts and returns (scaler, feature_names, type_clf, side_clf). Returns None
+    when the artifacts are missing, from another format version, or were exported from source files
+    that no longer match `sources` (a source_fingerprint() of the current models).
+    """
+    compact_dir = Path(compact_dir)
+    manifest_path = compact_dir / MANIFEST_FILENAME
+    if not manifest_path.exists(): return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != COMPACT_FORMAT_VERSION: return None
+    if sources is not None and manifest.get('sources') != sources: return None
+
+    def load(name):
+        path = compact_dir / f'{name}.npy'
+        # np.asarray drops the memmap subclass but keeps the lazily paged buffer, so indexing stays cheap
+        return np.asarray(np.load(path, mmap_mode='r', allow_pickle=False)) if path.exists() else None
+
+    scaler = CompactScaler(load('scaler_mean'), load('scaler_scale'), manifest['n_features'])
+    type_clf, side_clf = (CompactForest(*(load(f'{prefix}_{name}') for name in _FOREST_ARRAYS), n_features=manifest['n_features'])
+                          for prefix in ('type', 'side'))
+    return scaler, manifest['feature_names'], type_clf, side_clf
+
+
+def verify_compact_assets(assets, compact_assets, n_samples=2000, seed=0):
+    """Checks on random inputs around the training distribution that the compact models reproduce predict_proba exactly."""
+    scaler, _, type_clf, side_clf = assets
+    compact_scaler, _, compact_type, compact_side = compact_assets
+    rng = np.random.default_rng(seed)
+    mean = getattr(scaler, 'mean_', None); scale = getattr(scaler, 'scale_', None)
+    X = rng.normal(size=(n_samples, scaler.n_features_in_)) * (1 if scale is None else scale) + (0 if mean is None else mean)
+    scaled = scaler.transform(X)
+    compact_scaled = compact_scaler.transform(X)
+    return (np.array_equal(scaled, compact_scaled)
+            and np.array_equal(type_clf.predict_proba(scaled), compact_type.predict_proba(compact_scaled))
+            and np.array_equal(side_clf.predict_proba(scaled), compact_side.predict_proba(compact_scaled))
+            and np.array_equal(type_clf.predict(scaled), compact_type.predict(compact_scaled)))
+
+
+def export_verified_compact_models(assets, output_dir, sources=None):
+    """
+    Exports assets into a temporary directory next to output_dir, checks it with verify_compact_assets and only
+    then moves it into place, replacing any previous export. Returns False, leaving output_dir untouched, when the
+    export does not reproduce the original predictions, so a wrong export is never left for the loader to pick up.
+    """
+    output_dir = Path(output_dir)
+    output_dir.parent.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(prefix=f'.{output_dir.name}-', dir=output_dir.parent))
+    try:
+        export_compact_models(*assets, staging, sources=sources)
+        if not verify_compact_assets(assets, load_compact_assets(staging)): return False
+        if output_dir.exists():
+            retired = staging.with_name(staging.name + '-old')
+            output_dir.rename(retired)
+            staging.rename(output_dir)
+            shutil.rmtree(retired, ignore_errors=True)
+        else:
+            staging.rename(output_dir)
+        return True
+    finally:
+        if staging.exists(): shutil.rmtree(staging, ignore_errors=True)
+
+
+def main(argv=None):
+    import model_loader
+    parser = argparse.ArgumentParser(description="Export the trained models to memory-mapped .npy artifacts.")
+    parser.add_argument('--model-dir', default=str(model_loader.MODEL_DIR), help="Directory with the joblib models (default models_final).")
+    parser.add_argument('--output', help=f"Output directory (default <model-dir>/{model_loader.COMPACT_DIR_NAME}).")
+    args = parser.parse_args(argv)
+
+    assets = model_loader.load_prediction_assets(args.model_dir, prefer_compact=False)
+    if not all(a is not None for a in assets):
+        print("Prediction assets failed to load.", file=sys.stderr)
+        return 1
+    output = Path(args.output) if args.output else Path(args.model_dir) / model_loader.COMPACT_DIR_NAME
+    if not export_verified_compact_models(assets, output, sources=model_loader.model_source_fingerprint(args.model_dir)):
+        print(f"Exported models do not reproduce the original predictions; {output} was left unchanged.", file=sys.stderr)
+        return 1
+    size = sum(p.stat().st_size for p in output.iterdir())
+    print(f"Exported compact models to {output} ({size / 1e6:.1f} MB), predictions verified.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
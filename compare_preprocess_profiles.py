@@ -0,0 +1,89 @@
+"""
+Measures latency and prediction agreement of a preprocessing profile against the 'accurate' profile.
+
+Usage:
+    python compare_preprocess_profiles.py path/to/images [--profile fast] [--csv per_image.csv]
+"""
+import os
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import argparse
+import csv
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from image_processing_pipeline import PREPROCESS_PROFILES, run_recognition_pipeline
+from model_loader import load_prediction_assets
+from offline_recognition import collect_image_paths
+
+
+def _timed_run(frame, assets, profile):
+    scaler, feature_names, type_clf, side_clf = assets
+    start = time.perf_counter()
+    results, _ = run_recognition_pipeline(frame, scaler, type_clf, side_clf, feature_names, profile=profile)
+    return results, (time.perf_counter() - start) * 1000
+
+
+def compare_profiles(paths, assets, profile='fast', reference='accurate'):
+    """Runs every image through both profiles and returns one row per readable image."""
+    rows = []
+    for path in paths:
+        frame = cv2.imread(path)
+        if frame is None:
+            print(f"Skipping unreadable image: {path}", file=sys.stderr)
+            continue
+        ref_results, ref_ms = _timed_run(frame, assets, reference)
+        results, ms = _timed_run(frame, assets, profile)
+        rows.append({'path': path, 'reference_ms': ref_ms, 'profile_ms': ms,
+                     'reference_type': ref_results.get('coin_type'), 'profile_type': results.get('coin_type'),
+                     'reference_side': ref_results.get('coin_side'), 'profile_side': results.get('coin_side'),
+                     'reference_error': ref_results.get('error'), 'profile_error': results.get('error')})
+    return rows
+
+
+def summarize(rows, profile, reference):
+    ref_ms = np.array([r['reference_ms'] for r in rows]); ms = np.array([r['profile_ms'] for r in rows])
+    detected = [r for r in rows if r['reference_error'] is None and r['profile_error'] is None]
+    agree = lambda key: sum(r[f'reference_{key}'] == r[f'profile_{key}'] for r in detected)
+    n = len(rows); nd = len(detected)
+    print(f"Images compared: {n}")
+    print(f"Latency  {reference:>9}: median {np.median(ref_ms):7.1f} ms, p95 {np.percentile(ref_ms, 95):7.1f} ms")
+    print(f"Latency  {profile:>9}: median {np.median(ms):7.1f} ms, p95 {np.percentile(ms, 95):7.1f} ms")
+    print(f"Speedup (median): {np.median(ref_ms) / np.median(ms):.2f}x")
+    print(f"Detection agreement: {sum((r['reference_error'] is None) == (r['profile_error'] is None) for r in rows)}/{n}")
+    if nd:
+        print(f"Coin type agreement: {agree('type')}/{nd} ({100 * agree('type') / nd:.1f}%)")
+        print(f"Coin side agreement: {agree('side')}/{nd} ({100 * agree('side') / nd:.1f}%)")
+        both = sum(r['reference_type'] == r['profile_type'] and r['reference_side'] == r['profile_side'] for r in detected)
+        print(f"Both agree:          {both}/{nd} ({100 * both / nd:.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare a preprocessing profile against the 'accurate' profile.")
+    parser.add_argument('inputs', nargs='+', help="Image files, directories or @file lists.")
+    parser.add_argument('--profile', choices=PREPROCESS_PROFILES, default='fast', help="Profile to evaluate (default fast).")
+    parser.add_argument('--reference', choices=PREPROCESS_PROFILES, default='accurate', help="Reference profile (default accurate).")
+    parser.add_argument('--csv', help="Optional per-image CSV output.")
+    args = parser.parse_args(argv)
+
+    assets = load_prediction_assets()
+    if not all(a is not None for a in assets):
+        print("Prediction assets failed to load.", file=sys.stderr)
+        return 1
+    rows = compare_profiles(collect_image_paths(args.inputs), assets, args.profile, args.reference)
+    if not rows:
+        print("No images found.", file=sys.stderr)
+        return 1
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader(); writer.writerows(rows)
+    summarize(rows, args.profile, args.reference)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
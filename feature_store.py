@@ -0,0 +1,258 @@
+"""
+Persistent feature store that decouples feature extraction from classification.
+
+`extract` runs preprocessing, segmentation and feature extraction once per image and appends the
+feature vectors (ordered per feature_names.json) and the detected circle (x, y, r) to memory-mapped
+files, keyed by image path and a hash of the resized frame. Re-running it only processes new or
+changed images. `classify` streams the stored rows straight into the scaler and forests, so
+retrained or recalibrated models can re-score a whole archive without touching the images.
+
+Usage:
+    python feature_store.py extract images/ --store features/ [--profile accurate] [--crop-roi] [-w 8]
+    python feature_store.py classify --store features/ -o results.csv [--batch-size 256]
+"""
+import os
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from image_processing_pipeline import PREPROCESS_PROFILES, compile_feature_layout, predict_feature_probabilities, prepare_frame_features, results_from_probabilities
+from offline_recognition import RESULT_FIELDS, ResultWriter, chunked, collect_image_paths
+from result_cache import frame_digest
+
+STORE_FORMAT_VERSION = 1
+MANIFEST_FILENAME = 'manifest.json'
+FEATURES_FILENAME = 'features.f64'
+CIRCLES_FILENAME = 'circles.f64'
+INDEX_FILENAME = 'index.jsonl'
+
+
+class FeatureStore:
+    """
+    Append-only store of feature rows. features.f64 and circles.f64 hold raw float64 (rows, F) and
+    (rows, 3) arrays, index.jsonl one {row, path, digest, error} line per row (failed images also keep
+    their full error result), and manifest.json the feature names, extraction options and committed row
+    count. Appends write the data files first and the manifest last, so rows from an interrupted append
+    are ignored and truncated on the next open. The latest row for a path wins when an image is re-extracted.
+    """
+    def __init__(self, directory, feature_names, profile='accurate', crop_roi=False):
+        self.directory = Path(directory)
+        self.feature_names = list(feature_names)
+        self.n_features = len(self.feature_names)
+        self.profile, self.crop_roi = profile, crop_roi
+        self.rows = 0
+        self._latest = {}  # path -> index entry of its newest row
+        self.directory.mkdir(parents=True, exist_ok=True)
+        manifest_path = self.directory / MANIFEST_FILENAME
+        if manifest_path.exists():
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('format') != STORE_FORMAT_VERSION:
+                raise ValueError(f"Unsupported feature store format: {manifest.get('format')}")
+            if (manifest['feature_names'], manifest['profile'], manifest['crop_roi']) != (self.feature_names, profile, crop_roi):
+                raise ValueError("Feature store was built with different feature names or extraction options.")
+            self.rows = manifest['rows']
+        self._recover()
+
+    @classmethod
+    def open(cls, directory):
+        """Opens an existing store with the feature names and options it was built with."""
+        with open(Path(directory) / MANIFEST_FILENAME) as f:
+            manifest = json.load(f)
+        return cls(directory, manifest['feature_names'], manifest['profile'], manifest['crop_roi'])
+
+    def _path(self, filename):
+        return self.directory / filename
+
+    def _recover(self):
+        """Drops anything past the committed row count and loads the index."""
+        for filename, width in ((FEATURES_FILENAME, self.n_features), (CIRCLES_FILENAME, 3)):
+            with open(self._path(filename), 'ab') as f:
+                f.truncate(self.rows * width * 8)
+        index_path = self._path(INDEX_FILENAME)
+        lines = index_path.read_text().splitlines() if index_path.exists() else []
+        entries = [json.loads(line) for line in lines[:self.rows]]
+        if len(lines) != self.rows:
+            index_path.write_text(''.join(json.dumps(e) + '\n' for e in entries))
+        self._latest = {e['path']: e for e in entries}
+
+    def __len__(self):
+        return self.rows
+
+    def lookup(self, path):
+        return self._latest.get(path)
+
+    def entries(self):
+        """Index entries of the newest row per path, in the order the paths were first added."""
+        return list(self._latest.values())
+
+    def append(self, records):
+        """Appends (path, digest, feature_vector, circle, error_result) records; for failed images feature_vector is None and error_result a result dict."""
+        if not records: return
+        features = np.zeros((len(records), self.n_features))
+        circles = np.full((len(records), 3), np.nan)
+        entries = []
+        for i, (path, digest, vector, circle, error) in enumerate(records):
+            if vector is not None: features[i] = vector
+            if circle is not None: circles[i] = circle
+            entry = {'row': self.rows + i, 'path': path, 'digest': digest, 'error': error['error'] if error else None}
+            if error: entry['result'] = {k: error.get(k) for k in RESULT_FIELDS[1:]}
+            entries.append(entry)
+        with open(self._path(FEATURES_FILENAME), 'ab') as f: f.write(features.tobytes())
+        with open(self._path(CIRCLES_FILENAME), 'ab') as f: f.write(circles.tobytes())
+        with open(self._path(INDEX_FILENAME), 'a') as f: f.write(''.join(json.dumps(e) + '\n' for e in entries))
+        self.rows += len(records)
+        self._write_manifest()
+        for entry in entries:
+            self._latest.pop(entry['path'], None)  # Re-extracted paths move to the end
+            self._latest[entry['path']] = entry
+
+    def _write_manifest(self):
+        manifest = {'format': STORE_FORMAT_VERSION, 'feature_names': self.feature_names, 'profile': self.profile,
+                    'crop_roi': self.crop_roi, 'rows': self.rows}
+        tmp_path = self._path(MANIFEST_FILENAME + '.tmp')
+        with open(tmp_path, 'w') as f: json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self._path(MANIFEST_FILENAME))
+
+    def _memmap(self, filename, width):
+        if self.rows == 0: return np.zeros((0, width))
+        return np.memmap(self._path(filename), dtype=np.float64, mode='r', shape=(self.rows, width))
+
+    def features(self):
+        """Memory-mapped (rows, F) feature matrix."""
+        return self._memmap(FEATURES_FILENAME, self.n_features)
+
+    def circles(self):
+        """Memory-mapped (rows, 3) array of detected circles as x, y, r; NaN where no coin was found."""
+        return self._memmap(CIRCLES_FILENAME, 3)
+
+
+def _extract_chunk(paths, known_digests, feature_names, profile, crop_roi):
+    """Worker: returns (path, digest, vector, circle, error_result) per new or changed image, and None for unchanged ones."""
+    cv2.setNumThreads(1)
+    layout = compile_feature_layout(feature_names)
+    records = []
+    for path in paths:
+        frame = cv2.imread(path)
+        if frame is None:
+            unchanged = path in known_digests and known_digests[path] is None  # Already stored as unreadable
+            records.append(None if unchanged else (path, None, None, None, {'error': "Could not read image."}))
+            continue
+        frame = cv2.resize(frame, (300, 300), interpolation=cv2.INTER_AREA)
+        digest = frame_digest(frame)
+        if known_digests.get(path) == digest:
+            records.append(None)
+            continue
+        vector, error, _, circles = prepare_frame_features(frame, layout, visualize=False, profile=profile, crop_roi=crop_roi)
+        circle = circles[0, 0].astype(np.float64) if circles is not None else None
+        records.append((path, digest, vector, circle, error))
+    return records
+
+
+def extract_to_store(paths, store, workers=None, chunk_size=16):
+    """Extracts features for new or changed images into store with a process pool. Returns (added, unchanged)."""
+    added = unchanged = 0
+    chunks = list(chunked(list(paths), max(1, chunk_size)))
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(_extract_chunk, chunk, {p: e['digest'] for p in chunk if (e := store.lookup(p))},
+                                   store.feature_names, store.profile, store.crop_roi) for chunk in chunks]
+        for future in futures:
+            records = future.result()
+            new_records = [r for r in records if r is not None]
+            store.append(new_records)
+            added += len(new_records); unchanged += len(records) - len(new_records)
+    return added, unchanged
+
+
+def iter_store_results(store, scaler, type_clf, side_clf, feature_names, batch_size=256):
+    """
+    Classify-only mode: streams stored rows in batches into the scaler and forests and yields one
+    result record per stored path, identical to what offline_recognition produces for the image. Failed
+    images yield their stored error result, so error rows match too.
+    """
+    layout_names = list(feature_names)
+    if layout_names == store.feature_names:
+        columns = None
+    elif set(layout_names) <= set(store.feature_names):
+        columns = np.array([store.feature_names.index(name) for name in layout_names])
+    else:
+        raise ValueError("The models use features that are not in the store; re-extract with the current feature_names.json.")
+    features = store.features()
+    entries = store.entries()
+    for start in range(0, len(entries), batch_size):
+        batch = entries[start:start + batch_size]
+        valid = [e for e in batch if e['error'] is None]
+        results = {}
+        if valid:
+            X = features[[e['row'] for e in valid]]
+            if columns is not None: X = X[:, columns]
+            type_probas, side_probas = predict_feature_probabilities(X, scaler, type_clf, side_clf)
+            results = {e['path']: r for e, r in zip(valid, results_from_probabilities(type_probas, side_probas, type_clf, side_clf))}
+        for entry in batch:
+            # Stores written before error results were kept only have the message
+            result = results.get(entry['path']) or entry.get('result') or {'error': entry['error']}
+            yield {'path': entry['path'], **{k: result.get(k) for k in RESULT_FIELDS[1:]}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract coin features once into a store, then classify from the store.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    extract = commands.add_parser('extract', help="Append features for new or changed images to the store.")
+    extract.add_argument('inputs', nargs='+', help="Image files, directories or @file lists.")
+    extract.add_argument('--store', required=True, help="Feature store directory (created if missing).")
+    extract.add_argument('--profile', choices=PREPROCESS_PROFILES, default='accurate', help="Preprocessing profile (default accurate).")
+    extract.add_argument('--crop-roi', action='store_true', help="Extract features on the coin's bounding box.")
+    extract.add_argument('-w', '--workers', type=int, default=None, help="Worker processes (default: CPU count).")
+    extract.add_argument('--chunk-size', type=int, default=16, help="Images per worker task (default 16).")
+    classify = commands.add_parser('classify', help="Classify every image in the store without re-extracting features.")
+    classify.add_argument('--store', required=True, help="Feature store directory.")
+    classify.add_argument('-o', '--output', default='-', help="Output file (.csv or .jsonl). Defaults to stdout.")
+    classify.add_argument('--batch-size', type=int, default=256, help="Rows per classifier call (default 256).")
+    args = parser.parse_args(argv)
+
+    from model_loader import FEATURE_NAMES_PATH, load_prediction_assets
+    start = time.perf_counter()
+    if args.command == 'extract':
+        with open(FEATURE_NAMES_PATH) as f: feature_names = json.load(f)
+        try:
+            store = FeatureStore(args.store, feature_names, args.profile, args.crop_roi)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+        added, unchanged = extract_to_store(collect_image_paths(args.inputs), store, args.workers, args.chunk_size)
+        print(f"Added {added} rows, {unchanged} images unchanged; store holds {len(store.entries())} images "
+              f"({time.perf_counter() - start:.2f}s).", file=sys.stderr)
+        return 0
+
+    store = FeatureStore.open(args.store)
+    scaler, feature_names, type_clf, side_clf = load_prediction_assets()
+    if scaler is None:
+        print("Prediction assets failed to load.", file=sys.stderr)
+        return 1
+    fmt = 'jsonl' if args.output.endswith(('.jsonl', '.json')) else 'csv'
+    stream = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    processed = 0
+    try:
+        writer = ResultWriter(stream, fmt)
+        for record in iter_store_results(store, scaler, type_clf, side_clf, feature_names, args.batch_size):
+            writer.write(record)
+            processed += 1
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if stream is not sys.stdout: stream.close()
+    print(f"Classified {processed} stored images in {time.perf_counter() - start:.2f}s.", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
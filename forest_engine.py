@@ -0,0 +1,114 @@
+import weakref
+
+import numpy as np
+from compact_models import CompactForest, flatten_forest
+
+
+def _forest_arrays(forest):
+    """Node arrays of a CompactForest or a fitted sklearn random/extra-trees classifier, in the compact_models layout."""
+    if isinstance(forest, CompactForest):
+        return {'left': forest.left, 'right': forest.right, 'feature': forest.feature, 'threshold': forest.threshold,
+                'value': forest.value, 'roots': forest.roots, 'classes': forest.classes_}
+    from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
+    if not isinstance(forest, (RandomForestClassifier, ExtraTreesClassifier)):
+        raise TypeError(f"Unsupported classifier type: {type(forest).__name__}")
+    return flatten_forest(forest)
+
+
+class ForestEngine:
+    """
+    Evaluates several tree-ensemble classifiers over the same input rows in one pass. The nodes of all
+    trees of all forests are packed into one set of contiguous arrays, and every (sample, tree) pair
+    descends one level per step with vectorized gathers. Leaves point to themselves, so finished pairs
+    can ride along and are only dropped once they make up a quarter of the active set. Rows are processed
+    in chunks of about chunk_pairs (sample, tree) pairs to keep the working set in cache.
+    predict_proba returns one probability matrix per forest, bit-identical to sklearn's predict_proba
+    with the default n_jobs: inputs are cast to float32 and each forest's per-tree probabilities are
+    summed in tree order before dividing by its number of trees.
+    """
+    def __init__(self, forests, chunk_pairs=1 << 15):
+        self.chunk_pairs = chunk_pairs
+        arrays = [_forest_arrays(forest) for forest in forests]
+        n_features = {getattr(forest, 'n_features_in_', None) for forest in forests} - {None}
+        if len(n_features) > 1: raise ValueError(f"Forests expect different feature counts: {sorted(n_features)}")
+        self.n_features = n_features.pop() if n_features else None
+        node_offsets = np.cumsum([0] + [len(a['left']) for a in arrays])
+        tree_offsets = np.cumsum([0] + [len(a['roots']) for a in arrays])
+        left = np.concatenate([a['left'] + off for a, off in zip(arrays, node_offsets)])
+        right = np.concatenate([a['right'] + off for a, off in zip(arrays, node_offsets)])
+        self.is_internal = np.concatenate([a['left'] >= 0 for a in arrays])
+        nodes = np.arange(len(self.is_internal))
+        # children[2 * node] is the left child, children[2 * node + 1] the right one; leaves loop back to themselves
+        self.children = np.empty(2 * len(nodes), dtype=np.intp)
+        self.children[0::2] = np.where(self.is_internal, left, nodes)
+        self.children[1::2] = np.where(self.is_internal, right, nodes)
+        self.feature = np.concatenate([a['feature'] for a in arrays]).astype(np.intp)
+        self.threshold = np.concatenate([a['threshold'] for a in arrays]).astype(np.float64)
+        self.roots = np.concatenate([a['roots'] + off for a, off in zip(arrays, node_offsets)]).astype(np.intp)
+        # Per forest: (tree columns, node offset, per-node class probabilities)
+        self.forests = [(slice(int(t0), int(t1)), int(off), np.asarray(a['value']))
+                        for a, t0, t1, off in zip(arrays, tree_offsets[:-1], tree_offsets[1:], node_offsets)]
+        self.classes = [a['classes'] for a in arrays]
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def apply(self, X):
+        """(n_samples, n_trees) array with the packed index of the leaf each sample reaches in each tree of every forest."""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or (self.n_features is not None and X.shape[1] != self.n_features):
+            raise ValueError(f"X has shape {X.shape}, but the forests expect {self.n_features} features.")
+        n_samples, n_trees = X.shape[0], self.n_trees
+        x_flat = X.ravel()
+        leaves = np.empty(n_samples * n_trees, dtype=np.intp)
+        rows_per_chunk = max(1, self.chunk_pairs // n_trees)
+        for start in range(0, n_samples, rows_per_chunk):
+            stop = min(start + rows_per_chunk, n_samples)
+            position = np.arange(start * n_trees, stop * n_trees)
+            current = np.tile(self.roots, stop - start)
+            row_base = np.repeat(np.arange(start, stop, dtype=np.intp) * X.shape[1], n_trees)
+            while current.size:
+                go_left = x_flat[row_base + self.feature[current]] <= self.threshold[current]
+                current = self.children[2 * current + 1 - go_left]
+                internal = self.is_internal[current]
+                if np.count_nonzero(internal) < 0.75 * current.size:
+                    done = ~internal
+                    leaves[position[done]] = current[done]
+                    position, current, row_base = position[internal], current[internal], row_base[internal]
+        return leaves.reshape(n_samples, n_trees)
+
+    def predict_proba(self, X):
+        """List with one (n_samples, n_classes) probability matrix per forest, in construction order."""
+        leaves = self.apply(X)
+        probas = []
+        for trees, node_offset, value in self.forests:
+            # cumsum adds tree by tree, the same order sklearn accumulates in, so the sum is bit-identical
+            proba = np.cumsum(value[leaves[:, trees] - node_offset], axis=1)[:, -1]
+            proba /= trees.stop - trees.start
+            probas.append(proba)
+        return probas
+
+    def predict(self, X):
+        return [classes.take(np.argmax(proba, axis=1), axis=0) for classes, proba in zip(self.classes, self.predict_proba(X))]
+
+
+# First forest -> (the other forests, engine). Weakly keyed, so an engine is dropped together with its models.
+_FOREST_ENGINES = weakref.WeakKeyDictionary()
+
+def compile_forest_engine(*forests):
+    """
+    Returns the ForestEngine for these classifiers, or None when one of them is not a supported tree ensemble
+    (callers then use predict_proba). The engine is built on the first prediction rather than at model load,
+    since packing copies every node array and would page in memory-mapped models up front, and it is then
+    cached for as long as the classifiers are alive.
+    """
+    cached = _FOREST_ENGINES.get(forests[0])
+    if cached is not None and len(cached[0]) == len(forests) - 1 and all(a is b for a, b in zip(cached[0], forests[1:])):
+        return cached[1]
+    try:
+        engine = ForestEngine(forests)
+    except (TypeError, ValueError, AttributeError):
+        engine = None
+    _FOREST_ENGINES[forests[0]] = (forests[1:], engine)
+    return engine
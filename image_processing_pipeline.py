@@ -1,24 +1,39 @@
+import re
+from functools import cached_property, lru_cache
 import cv2
 import numpy as np
 from skimage.feature import local_binary_pattern, hog
+from pipeline_profiler import PROFILER, stage_timer
+from forest_engine import compile_forest_engine
 
-def preprocess_denoise_normalize(image):
+# 'accurate' is the non-local means denoising the models were trained with; 'fast' swaps it for an
+# edge-preserving bilateral filter that is roughly 40x cheaper, intended for live preview.
+PREPROCESS_PROFILES = ('accurate', 'fast')
+
+def preprocess_denoise_normalize(image, profile='accurate'):
     """Denoising with normalization"""
     if len(image.shape) == 3:
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     else:
         gray = image.copy()
     resized = cv2.resize(gray, (300, 300), interpolation=cv2.INTER_AREA)
-    denoised = cv2.fastNlMeansDenoising(resized, None, h=10, searchWindowSize=21, templateWindowSize=7)
+    if profile == 'accurate':
+        denoised = cv2.fastNlMeansDenoising(resized, None, h=10, searchWindowSize=21, templateWindowSize=7)
+    elif profile == 'fast':
+        denoised = cv2.bilateralFilter(resized, 9, 50, 50)
+    else:
+        raise ValueError(f"Unknown preprocessing profile '{profile}'. Expected one of {PREPROCESS_PROFILES}.")
     normalized = cv2.normalize(denoised, None, 0, 255, cv2.NORM_MINMAX)
     return normalized
 
-def segment_hough_circle(image):
-    """Hough Circle Transform that also returns the circle data for visualization."""
-    if image is None: return None, None, None
-    blurred = cv2.GaussianBlur(image, (9, 9), 2)
-    circles = cv2.HoughCircles(blurred, cv2.HOUGH_GRADIENT, dp=1.2, minDist=100,
-                               param1=50, param2=30, minRadius=50, maxRadius=150)
+HOUGH_PARAMS = {'dp': 1.2, 'minDist': 100, 'param1': 50, 'param2': 30, 'minRadius': 50, 'maxRadius': 150}
+
+def hough_blur(image):
+    """The smoothing applied before every Hough circle search."""
+    return cv2.GaussianBlur(image, (9, 9), 2)
+
+def segment_with_circle(image, circles):
+    """Masks image to the first of the detected circles; returns (segmented, mask, circles) like segment_hough_circle."""
     mask = np.zeros_like(image)
     if circles is not None:
         circles_uint = np.uint16(np.around(circles))
@@ -28,179 +43,613 @@ def segment_hough_circle(image):
     segmented = cv2.bitwise_and(image, image, mask=mask)
     return segmented, mask, circles
 
-def extract_shape_features(image_context, mask):
+def segment_hough_circle(image):
+    """Hough Circle Transform that also returns the circle data for visualization."""
+    if image is None: return None, None, None
+    circles = cv2.HoughCircles(hough_blur(image), cv2.HOUGH_GRADIENT, **HOUGH_PARAMS)
+    return segment_with_circle(image, circles)
+
+def segment_hough_circles_all(image, min_dist=None, min_radius=None, max_radius=None):
+    """
+    Hough Circle Transform that keeps every detected circle. Returns (circles, masks) with one
+    non-overlapping mask per circle: pixels covered by several circles go to the nearest centre.
+    The search uses HOUGH_PARAMS, with min_dist, min_radius and max_radius overriding it when given.
+    """
+    if image is None: return None, []
+    params = dict(HOUGH_PARAMS)
+    for name, value in (('minDist', min_dist), ('minRadius', min_radius), ('maxRadius', max_radius)):
+        if value is not None: params[name] = value
+    circles = cv2.HoughCircles(hough_blur(image), cv2.HOUGH_GRADIENT, **params)
+    if circles is None: return None, []
+    circles_uint = np.uint16(np.around(circles))
+    rows, cols = np.indices(image.shape[:2])
+    owner = np.full(image.shape[:2], -1, dtype=np.int32)
+    best_dist = np.full(image.shape[:2], np.inf)
+    disc = np.zeros_like(image)
+    for i, (x, y, r) in enumerate(circles_uint[0]):
+        disc[:] = 0
+        cv2.circle(disc, (x, y), r, 255, -1)
+        dist = (cols - int(x)) ** 2 + (rows - int(y)) ** 2
+        claim = (disc > 0) & (dist < best_dist)
+        owner[claim] = i
+        best_dist[claim] = dist[claim]
+    masks = [np.where(owner == i, 255, 0).astype(np.uint8) for i in range(circles_uint.shape[1])]
+    return circles, masks
+
+ROI_MARGIN = 4  # Pixels kept around a coin's bounding box when cropping, covering the LBP radius
+
+def circle_roi(circle, image_shape, margin=0):
+    """(row slice, column slice) of a circle's bounding box grown by margin, clamped to the image."""
+    x, y, r = (int(round(float(v))) for v in circle)
+    return (slice(max(0, y - r - margin), min(image_shape[0], y + r + margin + 1)),
+            slice(max(0, x - r - margin), min(image_shape[1], x + r + margin + 1)))
+
+class FeatureContext:
+    """
+    Per-frame intermediates shared by the feature extractors. The pixel count is computed up front,
+    everything else (boolean mask, masked image, contour, bounding box, masked colour pixels) lazily
+    and at most once, so extract_all_features does the mask work a single time for all extractors.
+    """
+    def __init__(self, gray_image, mask, bgr_image=None):
+        self.gray_image = gray_image
+        self.mask = mask
+        self.bgr_image = bgr_image
+        self.pixel_count = cv2.countNonZero(mask) if mask is not None else 0
+
+    @property
+    def is_empty(self):
+        return self.mask is None or self.pixel_count == 0
+
+    @cached_property
+    def mask_bool(self):
+        return self.mask > 0
+
+    @cached_property
+    def masked_gray(self):
+        return cv2.bitwise_and(self.gray_image, self.gray_image, mask=self.mask)
+
+    @cached_property
+    def largest_contour(self):
+        contours, _ = cv2.findContours(self.mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return max(contours, key=cv2.contourArea) if contours else None
+
+    @cached_property
+    def mask_window(self):
+        """(row slice, column slice) of the mask's bounding box."""
+        x, y, w, h = cv2.boundingRect(self.mask)
+        return slice(y, y + h), slice(x, x + w)
+
+    @cached_property
+    def masked_bgr_channels(self):
+        """(3, N) array with the B, G and R values of the pixels inside the mask, one contiguous row per channel."""
+        return np.ascontiguousarray(self.bgr_image[self.mask_bool].T)
+
+SHAPE_FEATURE_NAMES = ['area', 'perimeter', 'circularity', 'aspect_ratio', 'extent', 'solidity']
+HU_FEATURE_NAMES = [f'hu_moment_{i+1}' for i in range(7)]
+LBP_FEATURE_NAMES = [f'lbp_bin_{i+1}' for i in range(10)]
+HOG_FEATURE_NAMES = [f'hog_{i+1}' for i in range(20)]
+COLOR_FEATURE_NAMES = ([f'hist_{c}_{i+1}' for c in 'bgr' for i in range(5)] + [f'mean_{c}' for c in 'bgr']
+                       + [f'std_{c}' for c in 'bgr'] + [f'skewness_{c}' for c in 'bgr'])
+
+def _shape_values(ctx, out):
+    """Writes the shape features, in SHAPE_FEATURE_NAMES order, into out."""
+    out[:] = 0.0
+    largest_contour = ctx.largest_contour
+    if largest_contour is None: return
+    area = cv2.contourArea(largest_contour)
+    out[0] = area
+    perimeter = cv2.arcLength(largest_contour, True)
+    out[1] = perimeter
+    out[2] = (4 * np.pi * area / (perimeter * perimeter)) if perimeter > 0 else 0.0
+    x, y, w, h = cv2.boundingRect(largest_contour)
+    out[3] = float(w) / h if h > 0 else 0.0
+    out[4] = float(area) / (w * h) if (w * h) > 0 else 0.0
+    hull = cv2.convexHull(largest_contour)
+    hull_area = cv2.contourArea(hull)
+    out[5] = float(area) / hull_area if hull_area > 0 else 0.0
+
+def extract_shape_features(image_context, mask, ctx=None):
     """Extract shape features from segmented coin."""
-    features = {}
-    if mask is None or np.sum(mask) == 0:
-        return {name: 0.0 for name in ['area', 'perimeter', 'circularity', 'aspect_ratio', 'extent', 'solidity']}
-
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if contours:
-        largest_contour = max(contours, key=cv2.contourArea)
-        area = cv2.contourArea(largest_contour)
-        features['area'] = float(area)
-        perimeter = cv2.arcLength(largest_contour, True)
-        features['perimeter'] = float(perimeter)
-        features['circularity'] = (4 * np.pi * area / (perimeter * perimeter)) if perimeter > 0 else 0.0
-        x, y, w, h = cv2.boundingRect(largest_contour)
-        features['aspect_ratio'] = float(w) / h if h > 0 else 0.0
-        features['extent'] = float(area) / (w * h) if (w * h) > 0 else 0.0
-        hull = cv2.convexHull(largest_contour)
-        hull_area = cv2.contourArea(hull)
-        features['solidity'] = float(area) / hull_area if hull_area > 0 else 0.0
-    else:
-        features = {name: 0.0 for name in ['area', 'perimeter', 'circularity', 'aspect_ratio', 'extent', 'solidity']}
-    return features
+    ctx = ctx or FeatureContext(image_context, mask)
+    values = np.zeros(len(SHAPE_FEATURE_NAMES))
+    if not ctx.is_empty: _shape_values(ctx, values)
+    return dict(zip(SHAPE_FEATURE_NAMES, values.tolist()))
 
-def extract_hu_moments(gray_image, mask):
-    """Extract Hu moments from segmented coin"""
-    features = {}
-    if gray_image is None or mask is None or np.sum(mask) == 0:
-        return {f'hu_moment_{i+1}': 0.0 for i in range(7)}
-    moments = cv2.moments(mask)
-    hu_moments_array = cv2.HuMoments(moments)
+def _hu_values(ctx, out):
+    """Writes the log-scaled Hu moments of the mask into out."""
+    hu_moments_array = cv2.HuMoments(cv2.moments(ctx.mask))
     for i in range(7):
         val = hu_moments_array[i][0]
-        features[f'hu_moment_{i+1}'] = float(-1 * np.sign(val) * np.log10(abs(val))) if val != 0 else 0.0
-    return features
+        out[i] = -1 * np.sign(val) * np.log10(abs(val)) if val != 0 else 0.0
 
-def extract_lbp_features(gray_image, mask):
-    """Extract Local Binary Pattern features from segmented coin"""
-    features = {}
-    num_expected_lbp_bins = 10
-    if gray_image is None or mask is None or np.sum(mask) == 0:
-        return {f'lbp_bin_{i+1}': 0.0 for i in range(num_expected_lbp_bins)}
-    masked_image = cv2.bitwise_and(gray_image, gray_image, mask=mask)
+def extract_hu_moments(gray_image, mask, ctx=None):
+    """Extract Hu moments from segmented coin"""
+    ctx = ctx or FeatureContext(gray_image, mask)
+    values = np.zeros(len(HU_FEATURE_NAMES))
+    if gray_image is not None and not ctx.is_empty: _hu_values(ctx, values)
+    return dict(zip(HU_FEATURE_NAMES, values.tolist()))
+
+def _uniform_lbp_in_window(gray_image, window, n_points, radius):
+    """
+    Uniform LBP codes for the pixels in window, computed over the whole image with vectorized NumPy.
+    Mirrors skimage's local_binary_pattern arithmetic step for step (absolute sample coordinates,
+    bilinear weights, zero outside the image), so the codes are identical, but only the window is evaluated.
+    """
+    image = np.ascontiguousarray(gray_image, dtype=np.float64)
+    row_slice, col_slice = window
+    rows = np.arange(row_slice.start, row_slice.stop, dtype=np.float64)
+    cols = np.arange(col_slice.start, col_slice.stop, dtype=np.float64)
+    rp = np.round(-radius * np.sin(2 * np.pi * np.arange(n_points, dtype=np.float64) / n_points), 5)
+    cp = np.round(radius * np.cos(2 * np.pi * np.arange(n_points, dtype=np.float64) / n_points), 5)
+    pad = int(np.ceil(radius)) + 1
+    padded = np.zeros((image.shape[0] + 2 * pad, image.shape[1] + 2 * pad))
+    padded[pad:-pad, pad:-pad] = image
+    center = image[window]
+    h, w = center.shape
+    top, bottom, tmp = np.empty((h, w)), np.empty((h, w)), np.empty((h, w))
+    bit, prev_bit = np.empty((h, w), dtype=bool), np.empty((h, w), dtype=bool)
+    ones, changes = np.zeros((h, w), dtype=np.uint8), np.zeros((h, w), dtype=np.uint8)
+    for i in range(n_points):
+        r = rows + rp[i]; c = cols + cp[i]
+        min_r, min_c = np.floor(r), np.floor(c)
+        dr = (r - min_r)[:, None]; dc = (c - min_c)[None, :]
+        r0, r1 = int(min_r[0]) + pad, int(np.ceil(r[0])) + pad
+        c0, c1 = int(min_c[0]) + pad, int(np.ceil(c[0])) + pad
+        np.multiply(1 - dc, padded[r0:r0 + h, c0:c0 + w], out=top); np.multiply(dc, padded[r0:r0 + h, c1:c1 + w], out=tmp); top += tmp
+        np.multiply(1 - dc, padded[r1:r1 + h, c0:c0 + w], out=bottom); np.multiply(dc, padded[r1:r1 + h, c1:c1 + w], out=tmp); bottom += tmp
+        top *= 1 - dr; bottom *= dr; top += bottom; top -= center
+        np.greater_equal(top, 0, out=bit)
+        ones += bit
+        if i: changes += bit != prev_bit
+        bit, prev_bit = prev_bit, bit
+    return np.where(changes <= 2, ones, n_points + 1).astype(np.float64)
+
+@lru_cache(maxsize=None)
+def _uniform_lbp_matches_skimage():
+    """One-time check that _uniform_lbp_in_window reproduces the installed skimage exactly; otherwise skimage is used."""
+    rng = np.random.default_rng(0)
+    sample = rng.integers(0, 256, (48, 48), dtype=np.uint8)
+    sample[8:24, 8:40] //= 64
+    window = (slice(5, 45), slice(2, 30))
+    expected = local_binary_pattern(sample, 24, 3, method='uniform')[window]
+    return bool(np.array_equal(_uniform_lbp_in_window(sample, window, 24, 3), expected))
+
+def _lbp_values(ctx, out):
+    """Writes the normalized uniform-LBP histogram of the pixels inside the mask into out."""
+    out[:] = 0.0
     radius = 3; n_points = 8 * radius
-    lbp = local_binary_pattern(masked_image, n_points, radius, method='uniform')
-    lbp_values_in_mask = lbp[mask > 0]
+    window = ctx.mask_window
+    if _uniform_lbp_matches_skimage():
+        lbp = _uniform_lbp_in_window(ctx.masked_gray, window, n_points, radius)
+    else:
+        lbp = local_binary_pattern(ctx.masked_gray, n_points, radius, method='uniform')[window]
+    lbp_values_in_mask = lbp[ctx.mask_bool[window]]
     if len(lbp_values_in_mask) > 0:
         n_bins = int(lbp_values_in_mask.max() + 1)
         hist, _ = np.histogram(lbp_values_in_mask, bins=n_bins, range=(0, n_bins), density=True)
-        for i in range(min(num_expected_lbp_bins, len(hist))): features[f'lbp_bin_{i+1}'] = float(hist[i])
-        for i in range(len(hist), num_expected_lbp_bins): features[f'lbp_bin_{i+1}'] = 0.0
-    else:
-        for i in range(num_expected_lbp_bins): features[f'lbp_bin_{i+1}'] = 0.0
-    return features
+        n = min(len(out), len(hist))
+        out[:n] = hist[:n]
 
-def extract_hog_features(gray_image, mask):
-    """Extract Histogram of Oriented Gradients features from segmented coin."""
-    features_dict = {}
-    num_expected_hog_features = 20
-    if gray_image is None or mask is None or np.sum(mask) == 0:
-        return {f'hog_{i+1}': 0.0 for i in range(num_expected_hog_features)}
-    masked_image = cv2.bitwise_and(gray_image, gray_image, mask=mask)
-    resized = cv2.resize(masked_image, (64, 64))
-    hog_feature_vector, _ = hog(resized, orientations=9, pixels_per_cell=(8, 8), cells_per_block=(2, 2), block_norm='L2-Hys', visualize=True)
+def extract_lbp_features(gray_image, mask, ctx=None):
+    """Extract Local Binary Pattern features from segmented coin"""
+    ctx = ctx or FeatureContext(gray_image, mask)
+    values = np.zeros(len(LBP_FEATURE_NAMES))
+    if gray_image is not None and not ctx.is_empty: _lbp_values(ctx, values)
+    return dict(zip(LBP_FEATURE_NAMES, values.tolist()))
+
+def _hog_values(ctx, out):
+    """Writes an evenly strided selection of the HOG descriptor of the 64x64 masked image into out."""
+    out[:] = 0.0
+    resized = cv2.resize(ctx.masked_gray, (64, 64))
+    hog_feature_vector = hog(resized, orientations=9, pixels_per_cell=(8, 8), cells_per_block=(2, 2), block_norm='L2-Hys')
     if hog_feature_vector is not None and len(hog_feature_vector) > 0:
-        step = max(1, len(hog_feature_vector) // num_expected_hog_features)
-        selected_hog_features = hog_feature_vector[::step][:num_expected_hog_features]
-        for i, value in enumerate(selected_hog_features): features_dict[f'hog_{i+1}'] = float(value)
-        for i in range(len(selected_hog_features), num_expected_hog_features): features_dict[f'hog_{i+1}'] = 0.0
-    else:
-        for i in range(num_expected_hog_features): features_dict[f'hog_{i+1}'] = 0.0
-    return features_dict
+        step = max(1, len(hog_feature_vector) // len(out))
+        selected_hog_features = hog_feature_vector[::step][:len(out)]
+        out[:len(selected_hog_features)] = selected_hog_features
+
+def extract_hog_features(gray_image, mask, ctx=None):
+    """Extract Histogram of Oriented Gradients features from segmented coin."""
+    ctx = ctx or FeatureContext(gray_image, mask)
+    values = np.zeros(len(HOG_FEATURE_NAMES))
+    if gray_image is not None and not ctx.is_empty: _hog_values(ctx, values)
+    return dict(zip(HOG_FEATURE_NAMES, values.tolist()))
+
+_UINT8_LEVELS = np.arange(256, dtype=np.uint8)
 
-def extract_color_features(bgr_image_input, mask):
+def _color_values(ctx, out):
+    """Writes the per-channel histograms, means, standard deviations and skewness, in COLOR_FEATURE_NAMES order, into out."""
+    out[:] = 0.0
+    for c, channel_values_in_mask in enumerate(ctx.masked_bgr_channels):
+        if len(channel_values_in_mask) == 0: continue
+        # Pixels are uint8, so the histogram is built from 256 level counts, and the cubed z-scores
+        # are looked up per level instead of raising every pixel to the third power.
+        level_counts = np.bincount(channel_values_in_mask, minlength=256)
+        hist, _ = np.histogram(_UINT8_LEVELS, bins=5, range=(0, 256), weights=level_counts, density=True)
+        out[5 * c:5 * c + 5] = hist
+        mean_val = np.mean(channel_values_in_mask)
+        std_val = np.std(channel_values_in_mask)
+        out[15 + c] = mean_val
+        out[18 + c] = std_val
+        if std_val > 0:
+            cubed_z_by_level = ((_UINT8_LEVELS - mean_val) / std_val) ** 3
+            out[21 + c] = np.mean(cubed_z_by_level[channel_values_in_mask])
+
+def extract_color_features(bgr_image_input, mask, ctx=None):
     """Extract color features from segmented coin using a BGR image."""
-    features = {}
-    default_features = {f'hist_b_{i+1}': 0.0 for i in range(5)}
-    default_features.update({f'hist_g_{i+1}': 0.0 for i in range(5)})
-    default_features.update({f'hist_r_{i+1}': 0.0 for i in range(5)})
-    default_features.update({f'mean_{c}': 0.0 for c in 'bgr'})
-    default_features.update({f'std_{c}': 0.0 for c in 'bgr'})
-    default_features.update({f'skewness_{c}': 0.0 for c in 'bgr'})
-    if bgr_image_input is None or mask is None or np.sum(mask) == 0: return default_features
-    masked_color_image = cv2.bitwise_and(bgr_image_input, bgr_image_input, mask=mask)
-    b, g, r = cv2.split(masked_color_image)
-    for channel_pixels, name in [(b, 'b'), (g, 'g'), (r, 'r')]:
-        channel_values_in_mask = channel_pixels[mask > 0]
-        if len(channel_values_in_mask) > 0:
-            hist, _ = np.histogram(channel_values_in_mask, bins=5, range=(0, 256), density=True)
-            for i, value in enumerate(hist): features[f'hist_{name}_{i+1}'] = float(value)
-            mean_val = np.mean(channel_values_in_mask)
-            std_val = np.std(channel_values_in_mask)
-            features[f'mean_{name}'] = float(mean_val)
-            features[f'std_{name}'] = float(std_val)
-            features[f'skewness_{name}'] = float(np.mean(((channel_values_in_mask - mean_val) / std_val) ** 3)) if std_val > 0 else 0.0
-    return features
+    if ctx is None or ctx.bgr_image is None: ctx = FeatureContext(None, mask, bgr_image_input)
+    values = np.zeros(len(COLOR_FEATURE_NAMES))
+    if bgr_image_input is not None and not ctx.is_empty: _color_values(ctx, values)
+    return dict(zip(COLOR_FEATURE_NAMES, values.tolist()))
 
-def extract_all_features(segmented_gray_image, mask, feature_names_list_from_json, original_bgr_frame):
-    """Combines all feature types."""
-    all_features = {name: 0.0 for name in feature_names_list_from_json}
-    if segmented_gray_image is None or mask is None or np.sum(mask) == 0:
-        return all_features
-    
-    #Temporary dictionary to hold extracted features
-    temp_features = {}
-    temp_features.update(extract_shape_features(segmented_gray_image, mask))
-    temp_features.update(extract_hu_moments(segmented_gray_image, mask))
-    temp_features.update(extract_lbp_features(segmented_gray_image, mask))
-    temp_features.update(extract_hog_features(segmented_gray_image, mask))
-    temp_features.update(extract_color_features(original_bgr_frame, mask))
-
-    #Populate the final dictionary in the correct order
-    for key in all_features:
-        if key in temp_features:
-            all_features[key] = temp_features[key]
-            
-    return all_features
-
-def run_recognition_pipeline(frame_bgr, scaler, type_clf, side_clf, feature_names_from_json):
+DEFAULT_FEATURE_NAMES = SHAPE_FEATURE_NAMES + HU_FEATURE_NAMES + LBP_FEATURE_NAMES + HOG_FEATURE_NAMES + COLOR_FEATURE_NAMES
+
+# (profiling stage name, output names, extractor)
+_FEATURE_EXTRACTORS = [('shape', SHAPE_FEATURE_NAMES, _shape_values), ('hu', HU_FEATURE_NAMES, _hu_values), ('lbp', LBP_FEATURE_NAMES, _lbp_values),
+                       ('hog', HOG_FEATURE_NAMES, _hog_values), ('color', COLOR_FEATURE_NAMES, _color_values)]
+
+class FeatureLayout:
     """
-    Takes a raw BGR frame, runs the full pipeline, and returns prediction results
-    and a visualized frame for display.
+    Column layout of the model's feature vector, compiled once from feature_names.json.
+    Each extractor is mapped to the columns its outputs occupy; when those are a contiguous run in the
+    extractor's own order (the usual case), the extractor writes straight into a slice of the vector,
+    otherwise through a small scratch block that is scattered into place. Names no extractor produces stay 0.
+    A layout holds no per-frame state, so one layout can be shared by threads filling different vectors.
     """
-    if frame_bgr is None:
-        return {'error': "Input frame is None."}, None
+    def __init__(self, feature_names):
+        self.feature_names = list(feature_names)
+        self.n_features = len(self.feature_names)
+        self.extractors = []
+        for stage, names, extract_fn in _FEATURE_EXTRACTORS:
+            position = {name: j for j, name in enumerate(names)}
+            pairs = [(position[name], col) for col, name in enumerate(self.feature_names) if name in position]
+            if not pairs: continue
+            src = np.array([p[0] for p in pairs]); dst = np.array([p[1] for p in pairs])
+            if len(pairs) == len(names) and np.array_equal(src, np.arange(len(names))) and np.array_equal(dst, np.arange(dst[0], dst[0] + len(names))):
+                self.extractors.append((stage, extract_fn, slice(int(dst[0]), int(dst[0]) + len(names)), None, None))
+            else:
+                self.extractors.append((stage, extract_fn, len(names), src, dst))
+
+    def __len__(self):
+        return self.n_features
+
+    def new_vector(self):
+        return np.zeros(self.n_features)
+
+    def new_matrix(self, n_rows):
+        return np.zeros((n_rows, self.n_features))
+
+    def fill(self, ctx, out, timings=None):
+        """Runs every extractor on ctx and writes its values into the feature vector out, timing each into timings if given."""
+        for stage, extract_fn, target, src, dst in self.extractors:
+            with stage_timer(timings, stage):
+                if src is None:
+                    extract_fn(ctx, out[target])
+                else:
+                    scratch = np.zeros(target)  # Per call, so concurrent fills never share it
+                    extract_fn(ctx, scratch)
+                    out[dst] = scratch[src]
+
+    def to_dict(self, vector):
+        """Debug view of a feature vector as {feature name: value}."""
+        return dict(zip(self.feature_names, vector.tolist()))
+
+@lru_cache(maxsize=8)
+def _compile_layout_for_names(feature_names):
+    return FeatureLayout(feature_names)
+
+def compile_feature_layout(feature_names):
+    """
+    Returns the FeatureLayout for a feature name list, compiling it on first use. Layouts are cached by the
+    names themselves in a small LRU cache, so equal lists (e.g. reloaded or unpickled ones) share one layout.
+    """
+    if isinstance(feature_names, FeatureLayout): return feature_names
+    return _compile_layout_for_names(tuple(feature_names))
+
+def extract_feature_vector(segmented_gray_image, mask, feature_layout, original_bgr_frame, out=None, timings=None):
+    """
+    Extracts all features straight into a dense vector ordered per the layout (out is zero-filled and reused if given).
+    Per-extractor milliseconds are added to timings when a dict is passed.
+    """
+    layout = compile_feature_layout(feature_layout)
+    if out is None: out = layout.new_vector()
+    else: out[:] = 0.0
+    ctx = FeatureContext(segmented_gray_image, mask, original_bgr_frame)
+    if segmented_gray_image is None or ctx.is_empty:
+        return out
+    layout.fill(ctx, out, timings)
+    return out
+
+def extract_all_features(segmented_gray_image, mask, feature_names_list_from_json, original_bgr_frame):
+    """Combines all feature types. Dict view of extract_feature_vector, kept for debugging and analysis."""
+    layout = compile_feature_layout(feature_names_list_from_json)
+    return layout.to_dict(extract_feature_vector(segmented_gray_image, mask, layout, original_bgr_frame))
+
+def draw_detected_circles(visualized_frame, detected_circles):
+    """Draws every detected circle and its centre onto the visualization frame."""
+    if detected_circles is None: return
+    circles_uint = np.uint16(np.around(detected_circles))
+    for i in circles_uint[0, :]:
+        cv2.circle(visualized_frame, (i[0], i[1]), i[2], (0, 255, 0), 3) # Outer circle
+        cv2.circle(visualized_frame, (i[0], i[1]), 2, (0, 0, 255), 3)     # Center dot
 
-    frame_bgr = cv2.resize(frame_bgr, (300, 300), interpolation=cv2.INTER_AREA)
+def pipeline_error_result(message):
+    """Result dict for a frame the pipeline could not classify."""
+    return {'error': message, 'coin_type': "N/A", 'coin_side': "N/A", 'type_confidence': 0.0, 'side_confidence': 0.0}
 
-    visualized_frame = frame_bgr.copy()
-    error_result = {'error': "Pipeline error", 'coin_type': "N/A", 'coin_side': "N/A", 'type_confidence': 0.0, 'side_confidence': 0.0}
+# The pipeline steps below are shared by prepare_frame_features and the stages of stream_recognition.py.
+# Each step that can fail returns its outputs plus an error result, which is None on success.
 
-    preprocessed_gray = preprocess_denoise_normalize(frame_bgr)
+def resize_frame(frame_bgr, timings=None, copy=True):
+    """
+    Resizes a frame to the 300x300 pipeline input, always into a new array. With copy=False, a frame that
+    already has that size is returned as is; only pass that when the frame may be drawn on.
+    """
+    if not copy and frame_bgr.shape[:2] == (300, 300): return frame_bgr
+    with stage_timer(timings, 'resize'):
+        return cv2.resize(frame_bgr, (300, 300), interpolation=cv2.INTER_AREA)
+
+def preprocess_frame(frame_bgr, profile='accurate', timings=None):
+    """Returns (preprocessed_gray, error_result)."""
+    with stage_timer(timings, 'preprocess'):
+        preprocessed_gray = preprocess_denoise_normalize(frame_bgr, profile)
     if preprocessed_gray is None:
-        error_result['error'] = "Preprocessing failed."
-        return error_result, visualized_frame
+        return None, pipeline_error_result("Preprocessing failed.")
+    return preprocessed_gray, None
 
-    #Segmentation
-    segmented_gray, mask, detected_circles = segment_hough_circle(preprocessed_gray)
+def segment_frame(preprocessed_gray, timings=None):
+    """Returns (segmented_gray, mask, detected_circles, error_result). Circles are kept when no coin was found, so they can still be drawn."""
+    with stage_timer(timings, 'segment'):
+        segmented_gray, mask, detected_circles = segment_hough_circle(preprocessed_gray)
     if segmented_gray is None or mask is None:
-        error_result['error'] = "Segmentation failed."
-        return error_result, visualized_frame
+        return None, None, None, pipeline_error_result("Segmentation failed.")
+    if np.sum(mask) == 0:
+        return segmented_gray, mask, detected_circles, {'error': "No coin detected"}
+    return segmented_gray, mask, detected_circles, None
 
-    #Visualizations
-    if detected_circles is not None:
-        circles_uint = np.uint16(np.around(detected_circles))
-        for i in circles_uint[0, :]:
-            cv2.circle(visualized_frame, (i[0], i[1]), i[2], (0, 255, 0), 3) # Outer circle
-            cv2.circle(visualized_frame, (i[0], i[1]), 2, (0, 0, 255), 3)     # Center dot
+def extract_frame_features(segmented_gray, mask, detected_circles, frame_bgr, feature_layout, crop_roi=False, out=None, timings=None):
+    """Extracts the feature vector of a segmented frame, on the coin's bounding box (plus ROI_MARGIN) with crop_roi."""
+    if crop_roi:
+        roi = circle_roi(detected_circles[0, 0], mask.shape, ROI_MARGIN)
+        segmented_gray, mask, frame_bgr = segmented_gray[roi], mask[roi], frame_bgr[roi]
+    with stage_timer(timings, 'features'):
+        return extract_feature_vector(segmented_gray, mask, feature_layout, frame_bgr, out=out, timings=timings)
 
-    if np.sum(mask) == 0:
-        return {'error': "No coin detected"}, visualized_frame
+def prepare_frame_features(frame_bgr, feature_names_from_json, visualize=True, out=None, profile='accurate', crop_roi=False, timings=None,
+                           frame_owned=False):
+    """
+    Runs resize, preprocessing, segmentation and feature extraction for one frame.
+    Returns (feature_vector, error_result, visualized_frame, detected_circles); exactly one of
+    feature_vector and error_result is None. Features are written into out when given.
+    With crop_roi the extractors run on the coin's bounding box (plus ROI_MARGIN) instead
+    of the full 300x300 frame. HOG is then framed on the coin, and Hu moments 2-7 and some LBP
+    bins can change too (roi_parity_check.py reports which), so only models trained that way
+    should use it.
+    Stage timings are added to timings when a dict is passed. The input frame is never drawn on,
+    unless frame_owned says the caller allocated it for this call and lets it become the visualization.
+    """
+    frame_bgr = resize_frame(frame_bgr, timings, copy=visualize and not frame_owned)
+
+    # The 300x300 frame belongs to this call, so it becomes the visualization once the features have been read from it
+    visualized_frame = frame_bgr if visualize else None
+
+    preprocessed_gray, error_result = preprocess_frame(frame_bgr, profile, timings)
+    if error_result is not None:
+        return None, error_result, visualized_frame, None
+
+    #Segmentation
+    segmented_gray, mask, detected_circles, error_result = segment_frame(preprocessed_gray, timings)
+    if error_result is not None:
+        if visualize: draw_detected_circles(visualized_frame, detected_circles)
+        return None, error_result, visualized_frame, detected_circles
 
     #Feature Extraction
-    current_features_dict = extract_all_features(segmented_gray, mask, feature_names_from_json, original_bgr_frame=frame_bgr)
+    feature_vector = extract_frame_features(segmented_gray, mask, detected_circles, frame_bgr, feature_names_from_json, crop_roi, out, timings)
+
+    #Visualizations
+    if visualize:
+        draw_detected_circles(visualized_frame, detected_circles)
+    return feature_vector, None, visualized_frame, detected_circles
+
+FOREST_ENGINE_MAX_ROWS = 256  # Beyond this, sklearn's compiled per-tree loop is faster than the vectorized engine
+
+def predict_feature_probabilities(feature_matrix, scaler, type_clf, side_clf):
+    """
+    Scales an (N, F) feature matrix and returns (type_probas, side_probas). Tree ensembles are evaluated
+    together by one ForestEngine pass (always for compact models, up to FOREST_ENGINE_MAX_ROWS rows for
+    sklearn forests); other classifiers use their own predict_proba. All paths give identical probabilities.
+    """
+    scaled_features = scaler.transform(feature_matrix)
+    use_engine = len(scaled_features) <= FOREST_ENGINE_MAX_ROWS or not hasattr(type_clf, 'estimators_') or not hasattr(side_clf, 'estimators_')
+    engine = compile_forest_engine(type_clf, side_clf) if use_engine else None
+    if engine is not None:
+        type_probas, side_probas = engine.predict_proba(scaled_features)
+        return type_probas, side_probas
+    return type_clf.predict_proba(scaled_features), side_clf.predict_proba(scaled_features)
+
+def results_from_probabilities(type_probas, side_probas, type_clf, side_clf):
+    """Builds result dicts from class probabilities. Labels are taken from the argmax, as the forests' own predict does."""
+    pred_types = type_clf.classes_.take(np.argmax(type_probas, axis=1), axis=0)
+    pred_sides = side_clf.classes_.take(np.argmax(side_probas, axis=1), axis=0)
+    type_confidences = np.max(type_probas, axis=1) * 100
+    side_confidences = np.max(side_probas, axis=1) * 100
+    return [{'coin_type': str(pred_types[i]), 'coin_side': str(pred_sides[i]), 'type_confidence': float(type_confidences[i]), 'side_confidence': float(side_confidences[i]), 'error': None}
+            for i in range(type_probas.shape[0])]
+
+def _predict_feature_matrix(feature_matrix, scaler, type_clf, side_clf):
+    """Scales and classifies all rows of an (N, F) feature matrix in one batched classifier pass."""
+    type_probas, side_probas = predict_feature_probabilities(feature_matrix, scaler, type_clf, side_clf)
+    return results_from_probabilities(type_probas, side_probas, type_clf, side_clf)
+
+def run_recognition_pipeline(frame_bgr, scaler, type_clf, side_clf, feature_names_from_json, profile='accurate', crop_roi=False, frame_owned=False):
+    """
+    Takes a raw BGR frame, runs the full pipeline, and returns prediction results
+    and a visualized frame for display. profile selects the preprocessing profile
+    (see PREPROCESS_PROFILES); crop_roi extracts features on the coin's bounding box
+    rather than the full frame (the shipped models were trained on the full frame).
+    While pipeline_profiler.PROFILER is enabled, results carry a 'timings' dict of
+    per-stage milliseconds, which are also added to the profiler's histograms.
+    With frame_owned, a frame that is already 300x300 (e.g. resized by the caller to key a cache)
+    is drawn on and returned as the visualized frame instead of being copied first.
+    """
+    timings = PROFILER.new_frame()
+    with stage_timer(timings, 'total'):
+        results, visualized_frame = _recognize_frame(frame_bgr, scaler, type_clf, side_clf, feature_names_from_json, profile, crop_roi, timings,
+                                                     frame_owned)
+    if timings is not None:
+        results['timings'] = timings
+        PROFILER.record(timings)
+    return results, visualized_frame
+
+def _recognize_frame(frame_bgr, scaler, type_clf, side_clf, feature_names_from_json, profile, crop_roi, timings, frame_owned):
+    if frame_bgr is None:
+        return {'error': "Input frame is None."}, None
 
-    #Create Feature Vector
-    feature_vector = np.array([current_features_dict.get(name, 0.0) for name in feature_names_from_json]).reshape(1, -1)
+    feature_vector, frame_error, visualized_frame, _ = prepare_frame_features(frame_bgr, feature_names_from_json, profile=profile, crop_roi=crop_roi, timings=timings,
+                                                                                frame_owned=frame_owned)
+    if frame_error is not None:
+        return frame_error, visualized_frame
 
+    feature_vector = feature_vector.reshape(1, -1)
     if feature_vector.shape[1] != scaler.n_features_in_:
-        error_result['error'] = f"Feature shape mismatch. Expected {scaler.n_features_in_}."
-        return error_result, visualized_frame
+        return pipeline_error_result(f"Feature shape mismatch. Expected {scaler.n_features_in_}."), visualized_frame
 
     #Scale and Predict
     try:
-        scaled_features = scaler.transform(feature_vector)
-        pred_type = type_clf.predict(scaled_features)[0]
-        type_proba = np.max(type_clf.predict_proba(scaled_features)) * 100
-        pred_side = side_clf.predict(scaled_features)[0]
-        side_proba = np.max(side_clf.predict_proba(scaled_features)) * 100
+        with stage_timer(timings, 'classify'):
+            final_results = _predict_feature_matrix(feature_vector, scaler, type_clf, side_clf)[0]
     except Exception as e:
-        error_result['error'] = f"Prediction failed: {e}"
-        return error_result, visualized_frame
+        return pipeline_error_result(f"Prediction failed: {e}"), visualized_frame
 
-    #Final results
-    final_results = {'coin_type': str(pred_type), 'coin_side': str(pred_side), 'type_confidence': float(type_proba), 'side_confidence': float(side_proba), 'error': None}
     return final_results, visualized_frame
+
+def run_recognition_batch(frames, scaler, type_clf, side_clf, feature_names_from_json, visualize=True, profile='accurate', crop_roi=False):
+    """
+    Batched form of run_recognition_pipeline for offline use. Every frame is
+    preprocessed, segmented and feature-extracted, then all valid rows are stacked
+    into one (N, F) matrix so the scaler and each classifier run once per batch.
+    Returns (results, visualized_frames), one entry per input frame, with result
+    dicts identical to the single-frame path. visualize=False skips drawing.
+    With profiling enabled, each frame's 'timings' includes its share of the batched
+    'classify' stage.
+    """
+    frames = list(frames)
+    layout = compile_feature_layout(feature_names_from_json)
+    feature_matrix = layout.new_matrix(len(frames))
+    results, visualized_frames, valid_indices = [], [], []
+    frame_timings = [PROFILER.new_frame() for _ in frames]
+    for frame_bgr, timings in zip(frames, frame_timings):
+        if frame_bgr is None:
+            results.append({'error': "Input frame is None."}); visualized_frames.append(None)
+            continue
+        row = feature_matrix[len(valid_indices)]
+        with stage_timer(timings, 'total'):
+            _, frame_error, visualized_frame, _ = prepare_frame_features(frame_bgr, layout, visualize=visualize, out=row, profile=profile, crop_roi=crop_roi, timings=timings)
+        results.append(frame_error); visualized_frames.append(visualized_frame)
+        if frame_error is None:
+            valid_indices.append(len(results) - 1)
+
+    if valid_indices:
+        classify_batch_rows(results, valid_indices, feature_matrix, scaler, type_clf, side_clf, frame_timings)
+    if frame_timings and frame_timings[0] is not None:
+        for result, timings in zip(results, frame_timings):
+            result['timings'] = timings
+            PROFILER.record(timings)
+    return results, visualized_frames
+
+def classify_batch_rows(results, valid_indices, feature_matrix, scaler, type_clf, side_clf, frame_timings):
+    """Classifies the first len(valid_indices) rows of feature_matrix in one call and stores each result at its frame index."""
+    batch_timings = {} if frame_timings[0] is not None else None
+
+    feature_matrix = feature_matrix[:len(valid_indices)]
+    if feature_matrix.shape[1] != scaler.n_features_in_:
+        batch_results = [pipeline_error_result(f"Feature shape mismatch. Expected {scaler.n_features_in_}.") for _ in valid_indices]
+    else:
+        try:
+            with stage_timer(batch_timings, 'classify'):
+                batch_results = _predict_feature_matrix(feature_matrix, scaler, type_clf, side_clf)
+        except Exception as e:
+            batch_results = [pipeline_error_result(f"Prediction failed: {e}") for _ in valid_indices]
+
+    classify_share = batch_timings.get('classify', 0.0) / len(valid_indices) if batch_timings is not None else 0.0
+    for idx, frame_result in zip(valid_indices, batch_results):
+        results[idx] = frame_result
+        if batch_timings is not None:
+            frame_timings[idx]['classify'] = classify_share
+            frame_timings[idx]['total'] += classify_share
+
+def coin_value_in_rand(coin_type):
+    """
+    Parses a coin type label such as 'R5', '2 Rand', '50c' or '10 cents' into its value in rand.
+    Returns None for labels that do not name a denomination.
+    """
+    match = re.fullmatch(r'\s*(?:r\s*)?(\d+(?:[.,]\d+)?)\s*(rand|r|cents?|c)?\s*', str(coin_type).lower().replace('_', ' '))
+    if not match: return None
+    amount = float(match.group(1).replace(',', '.'))
+    unit = match.group(2) or ('rand' if str(coin_type).strip().lower().startswith('r') else None)
+    if unit is None: return None
+    return amount / 100 if unit.startswith('c') else amount
+
+def run_multi_coin_pipeline(frame_bgr, scaler, type_clf, side_clf, feature_names_from_json, profile='accurate',
+                            min_dist=None, min_radius=None, max_radius=None, crop_roi=False, frame_owned=False):
+    """
+    Multi-coin mode for counting trays. Every detected circle gets its own non-overlapping mask, features are
+    extracted on the full frame with only that coin's mask, as the shipped full-frame models expect (or, with
+    crop_roi, on a crop around each coin, as in run_recognition_pipeline), and all coins are classified together
+    in one batched call.
+    Returns (results, visualized_frame); results holds the per-coin result dicts (each with its 'circle'
+    and 'value' in rand) under 'coins', plus 'coin_count' and 'total_value'. Coins whose type does not
+    parse as a denomination have value None and are left out of the total. min_dist, min_radius and
+    max_radius default to HOUGH_PARAMS. frame_owned works as in run_recognition_pipeline.
+    """
+    timings = PROFILER.new_frame()
+    with stage_timer(timings, 'total'):
+        results, visualized_frame = _recognize_coins(frame_bgr, scaler, type_clf, side_clf, feature_names_from_json, profile,
+                                                     min_dist, min_radius, max_radius, crop_roi, timings, frame_owned)
+    if timings is not None:
+        results['timings'] = timings
+        PROFILER.record(timings)
+    return results, visualized_frame
+
+def _recognize_coins(frame_bgr, scaler, type_clf, side_clf, feature_names_from_json, profile, min_dist, min_radius, max_radius, crop_roi, timings,
+                     frame_owned):
+    if frame_bgr is None:
+        return {'error': "Input frame is None."}, None
+
+    frame_bgr = resize_frame(frame_bgr, timings, copy=not frame_owned)
+    visualized_frame = frame_bgr  # Drawn on only after the colour features have been read from it
+    empty_result = {'coins': [], 'coin_count': 0, 'total_value': 0.0, 'error': None}
+
+    with stage_timer(timings, 'preprocess'):
+        preprocessed_gray = preprocess_denoise_normalize(frame_bgr, profile)
+    with stage_timer(timings, 'segment'):
+        circles, masks = segment_hough_circles_all(preprocessed_gray, min_dist=min_dist, min_radius=min_radius, max_radius=max_radius)
+    if not masks:
+        draw_detected_circles(visualized_frame, circles)
+        return {**empty_result, 'error': "No coin detected"}, visualized_frame
+
+    layout = compile_feature_layout(feature_names_from_json)
+    if layout.n_features != scaler.n_features_in_:
+        draw_detected_circles(visualized_frame, circles)
+        return {**empty_result, 'error': f"Feature shape mismatch. Expected {scaler.n_features_in_}."}, visualized_frame
+    feature_matrix = layout.new_matrix(len(masks))
+    for i, (circle, mask) in enumerate(zip(circles[0], masks)):
+        roi = circle_roi(circle, mask.shape, ROI_MARGIN) if crop_roi else (slice(None), slice(None))
+        mask_roi = mask[roi]
+        gray_roi = preprocessed_gray[roi]
+        segmented_roi = cv2.bitwise_and(gray_roi, gray_roi, mask=mask_roi)
+        with stage_timer(timings, 'features'):
+            extract_feature_vector(segmented_roi, mask_roi, layout, frame_bgr[roi], out=feature_matrix[i], timings=timings)
+    draw_detected_circles(visualized_frame, circles)
+
+    try:
+        with stage_timer(timings, 'classify'):
+            coins = _predict_feature_matrix(feature_matrix, scaler, type_clf, side_clf)
+    except Exception as e:
+        return {**empty_result, 'error': f"Prediction failed: {e}"}, visualized_frame
+
+    for coin, circle in zip(coins, np.uint16(np.around(circles))[0]):
+        coin['circle'] = tuple(int(v) for v in circle)
+        coin['value'] = coin_value_in_rand(coin['coin_type'])
+        cv2.putText(visualized_frame, coin['coin_type'], (int(circle[0]) - 15, int(circle[1]) + 5), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 2)
+    total_value = sum(coin['value'] for coin in coins if coin['value'] is not None)
+    return {'coins': coins, 'coin_count': len(coins), 'total_value': float(total_value), 'error': None}, visualized_frame
@@ -0,0 +1,406 @@
+"""
+Local HTTP inference service, so several counting stations can share one set of models.
+
+The service loads the prediction assets once and serves:
+    POST /recognize[?profile=fast]   JPEG/PNG body -> single-coin result, plus the detected 'circles'
+    POST /count[?profile=fast]       JPEG/PNG body -> multi-coin result ('coins', 'coin_count', 'total_value')
+    GET  /health                     status, model fingerprint, workers, uptime
+    GET  /metrics                    Prometheus text: latency percentiles per phase, batch sizes, queue depth
+    GET  /metrics.json               the same as JSON
+Concurrent /recognize requests are collected into micro-batches. A batch closes once it holds
+max_batch_size requests or max_wait_ms after its first request arrived. Decoding and feature extraction
+run on a process pool, and then the whole batch is scored by one classifier call.
+
+Usage:
+    python inference_service.py [--host 127.0.0.1] [--port 8765] [-w 4] [--max-batch-size 16] [--max-wait-ms 5]
+Set COIN_INFERENCE_URL=http://<host>:8765 before starting the app to use the service instead of local models.
+"""
+import os
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import argparse
+import asyncio
+import http.client
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+import numpy as np
+
+from image_processing_pipeline import (PREPROCESS_PROFILES, classify_batch_rows, compile_feature_layout, draw_detected_circles,
+                                       prepare_frame_features, resize_frame, run_multi_coin_pipeline)
+from pipeline_profiler import StageProfiler
+
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+
+_worker_layout = None
+_worker_crop_roi = False
+
+
+def _init_worker(feature_names, crop_roi=False):
+    """Process-pool initializer: feature extraction needs only the feature layout, not the models."""
+    global _worker_layout, _worker_crop_roi
+    cv2.setNumThreads(1)  # Parallelism comes from the pool; avoid oversubscribing cores
+    _worker_layout = compile_feature_layout(feature_names)
+    _worker_crop_roi = crop_roi
+
+
+def _decode_image(data):
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR) if data else None
+
+
+def _extract_upload(data, profile):
+    """Worker: decodes an uploaded image and returns (feature_vector, error_result, circles as [[x, y, r], ...])."""
+    frame = _decode_image(data)
+    if frame is None: return None, {'error': "Could not decode image."}, None
+    feature_vector, error_result, _, circles = prepare_frame_features(frame, _worker_layout, visualize=False, profile=profile, crop_roi=_worker_crop_roi)
+    return feature_vector, error_result, None if circles is None else circles[0].tolist()
+
+
+class _PendingRequest:
+    __slots__ = ('data', 'profile', 'future', 'enqueued')
+
+    def __init__(self, data, profile, future):
+        self.data, self.profile, self.future = data, profile, future
+        self.enqueued = time.perf_counter()
+
+
+class InferenceService:
+    """
+    asyncio HTTP server around the recognition pipeline. /recognize requests wait in a queue of at most
+    max_queue requests (beyond that the service answers 503). A batcher task groups them into micro-batches,
+    and up to max_inflight_batches are processed at once: features on a pool of `workers` processes, then one
+    classify_batch_rows call on a dedicated thread. /count runs run_multi_coin_pipeline on a thread, with at
+    most max_queue requests admitted at once (again 503 beyond that).
+    Per-request phase latencies (queue_wait, extract, classify, request) are kept in a StageProfiler.
+    """
+    def __init__(self, assets, fingerprint=None, workers=None, max_batch_size=16, max_wait_ms=5.0, max_queue=256,
+                 max_inflight_batches=2, profile='accurate', crop_roi=False):
+        self.scaler, self.feature_names, self.type_clf, self.side_clf = assets
+        self.fingerprint = fingerprint
+        self.workers = workers or os.cpu_count() or 1
+        self.max_batch_size, self.max_wait = max_batch_size, max_wait_ms / 1000
+        self.max_queue, self.max_inflight_batches = max_queue, max_inflight_batches
+        self.profile, self.crop_roi = profile, crop_roi
+        self.latency = StageProfiler(enabled=True)
+        self.counters = {'requests': 0, 'rejected': 0, 'errors': 0, 'batches': 0, 'batched_requests': 0, 'max_queue_depth': 0}
+        self.batch_sizes = {}
+        self.started = time.time()
+        self._queue = None
+        self._server = None
+        self._batch_tasks = set()
+        self._count_pending = 0
+
+    async def start(self, host='127.0.0.1', port=8765):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._slots = asyncio.Semaphore(self.max_inflight_batches)
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self.feature_names, self.crop_roi))
+        self._classify_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='classify')
+        self._count_executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='count')
+        self._batcher_task = asyncio.create_task(self._batcher())
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        async with self._server: await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher_task.cancel()
+        self._pool.shutdown(cancel_futures=True)
+        self._classify_executor.shutdown(); self._count_executor.shutdown()
+
+    # Micro-batching
+
+    async def recognize(self, data, profile):
+        """Queues one upload for the next micro-batch and returns its result dict. Raises asyncio.QueueFull when saturated."""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_PendingRequest(data, profile, future))
+        self.counters['max_queue_depth'] = max(self.counters['max_queue_depth'], self._queue.qsize())
+        return await future
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # The wait counts from when the first request arrived, so a backlog is batched without extra delay
+            deadline = loop.time() + max(0.0, self.max_wait - (time.perf_counter() - batch[0].enqueued))
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0: break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._slots.acquire()
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batch_tasks.add(task)  # The loop only keeps weak references to tasks
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            started = time.perf_counter()
+            extracted = await asyncio.gather(*(loop.run_in_executor(self._pool, _extract_upload, r.data, r.profile) for r in batch), return_exceptions=True)
+            extracted_at = time.perf_counter()
+            results, circles, valid = [], [], []
+            for i, item in enumerate(extracted):
+                if isinstance(item, BaseException):
+                    results.append({'error': f"Feature extraction failed: {item}"}); circles.append(None)
+                    continue
+                feature_vector, error_result, item_circles = item
+                results.append(error_result); circles.append(item_circles)
+                if error_result is None: valid.append(i)
+            if valid:
+                feature_matrix = np.stack([extracted[i][0] for i in valid])
+                await loop.run_in_executor(self._classify_executor, classify_batch_rows, results, valid, feature_matrix,
+                                           self.scaler, self.type_clf, self.side_clf, [None] * len(batch))
+            finished = time.perf_counter()
+            self.counters['batches'] += 1
+            self.counters['batched_requests'] += len(batch)
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+            for request, result, request_circles in zip(batch, results, circles):
+                self.latency.record({'queue_wait': (started - request.enqueued) * 1000, 'extract': (extracted_at - started) * 1000,
+                                     'classify': (finished - extracted_at) * 1000})
+                if not request.future.done(): request.future.set_result({**result, 'circles': request_circles})
+        except Exception as e:
+            for request in batch:
+                if not request.future.done(): request.future.set_exception(e)
+        finally:
+            self._slots.release()
+
+    async def count(self, data, profile):
+        """Runs the multi-coin pipeline on the count thread pool. Raises asyncio.QueueFull when max_queue counts are pending."""
+        if self._count_pending >= self.max_queue: raise asyncio.QueueFull
+        def run():
+            frame = _decode_image(data)
+            if frame is None: return {'error': "Could not decode image."}
+            results, _ = run_multi_coin_pipeline(frame, self.scaler, self.type_clf, self.side_clf, self.feature_names, profile=profile,
+                                                 crop_roi=self.crop_roi)
+            results.pop('timings', None)
+            return results
+        self._count_pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._count_executor, run)
+        finally:
+            self._count_pending -= 1
+
+    # HTTP
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line: break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, {'error': "Malformed request line."}, keep_alive=False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''): break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                content_length = headers.get('content-length') or '0'
+                if not (content_length.isascii() and content_length.isdigit()):
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, {'error': "Invalid Content-Length."}, keep_alive=False)
+                    break
+                length = int(content_length)
+                if length > MAX_UPLOAD_BYTES:
+                    await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {'error': "Upload too large."}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                status, payload, content_type = await self._route(method, target, body)
+                await self._respond(writer, status, payload, keep_alive, content_type)
+                if not keep_alive: break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == '/health' and method == 'GET': return HTTPStatus.OK, self.health(), None
+        if url.path == '/metrics' and method == 'GET': return HTTPStatus.OK, self.metrics_text(), 'text/plain; version=0.0.4'
+        if url.path == '/metrics.json' and method == 'GET': return HTTPStatus.OK, self.metrics(), None
+        if url.path not in ('/recognize', '/count'): return HTTPStatus.NOT_FOUND, {'error': "Not found."}, None
+        if method != 'POST': return HTTPStatus.METHOD_NOT_ALLOWED, {'error': "Use POST with the image as the request body."}, None
+        profile = parse_qs(url.query).get('profile', [self.profile])[0]
+        if profile not in PREPROCESS_PROFILES: return HTTPStatus.BAD_REQUEST, {'error': f"Unknown profile: {profile}"}, None
+        if not body: return HTTPStatus.BAD_REQUEST, {'error': "Empty request body."}, None
+        self.counters['requests'] += 1
+        start = time.perf_counter()
+        try:
+            result = await (self.recognize(body, profile) if url.path == '/recognize' else self.count(body, profile))
+        except asyncio.QueueFull:
+            self.counters['rejected'] += 1
+            return HTTPStatus.SERVICE_UNAVAILABLE, {'error': "Service busy, retry later."}, None
+        except Exception as e:
+            self.counters['errors'] += 1
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f"Recognition failed: {e}"}, None
+        self.latency.record({'request' if url.path == '/recognize' else 'count': (time.perf_counter() - start) * 1000})
+        return HTTPStatus.OK, result, None
+
+    async def _respond(self, writer, status, payload, keep_alive=True, content_type=None):
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        head = (f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: {content_type or 'application/json'}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+    # Monitoring
+
+    def health(self):
+        return {'status': 'ok', 'model_fingerprint': self.fingerprint, 'workers': self.workers, 'uptime_s': time.time() - self.started,
+                'queue_depth': self._queue.qsize() if self._queue else 0}
+
+    def metrics(self):
+        batches = self.counters['batches']
+        return {**self.counters, 'queue_depth': self._queue.qsize() if self._queue else 0,
+                'mean_batch_size': self.counters['batched_requests'] / batches if batches else 0.0,
+                'batch_sizes': {str(size): n for size, n in sorted(self.batch_sizes.items())}, 'latency_ms': self.latency.snapshot()}
+
+    def metrics_text(self):
+        """Prometheus text exposition of metrics()."""
+        m = self.metrics()
+        lines = [self.latency.to_prometheus('coin_service_latency_ms').rstrip('\n')]
+        for name in ('requests', 'rejected', 'errors', 'batches', 'batched_requests'):
+            lines += [f"# TYPE coin_service_{name}_total counter", f"coin_service_{name}_total {m[name]}"]
+        for name in ('queue_depth', 'max_queue_depth', 'mean_batch_size'):
+            lines += [f"# TYPE coin_service_{name} gauge", f"coin_service_{name} {m[name]}"]
+        return '\n'.join(lines) + '\n'
+
+
+class InferenceClient:
+    """
+    Blocking client for InferenceService, used by the app as a remote backend. recognize() and count()
+    mirror run_recognition_pipeline and run_multi_coin_pipeline: they return (results, visualized_frame), with
+    the circles drawn on the 300x300 frame that was sent. Frames are resized before upload, as the pipeline
+    would, and sent as lossless PNG, so results match local inference. One keep-alive connection is shared
+    under a lock. When the service cannot be reached or refuses a request, the results carry an error and
+    retryable=True instead of raising.
+    """
+    def __init__(self, base_url, timeout=10.0):
+        url = urlsplit(base_url if '://' in base_url else f'http://{base_url}')
+        self.host, self.port = url.hostname, url.port or 80
+        self.timeout = timeout
+        self._connection = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.total_latency = 0.0
+
+    def _request(self, method, path, body=None):
+        with self._lock:
+            for attempt in range(2):  # The service may have closed an idle keep-alive connection; retry once on a fresh one
+                if self._connection is None: self._connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                try:
+                    self._connection.request(method, path, body=body, headers={'Content-Type': 'image/png'} if body else {})
+                    response = self._connection.getresponse()
+                    return response.status, json.loads(response.read())
+                except (http.client.HTTPException, OSError):
+                    self._connection.close(); self._connection = None
+                    if attempt: raise
+
+    def health(self):
+        """The service's /health document, or None when it cannot be reached."""
+        try:
+            status, payload = self._request('GET', '/health')
+        except (http.client.HTTPException, OSError, ValueError):
+            return None
+        return payload if status == 200 else None
+
+    def _post_frame(self, path, frame_bgr, profile, copy):
+        frame_bgr = resize_frame(frame_bgr, copy=copy)
+        start = time.perf_counter()
+        try:
+            status, payload = self._request('POST', f'{path}?profile={profile}', cv2.imencode('.png', frame_bgr)[1].tobytes())
+        except (http.client.HTTPException, OSError, ValueError) as e:
+            status, payload = None, {'error': f"Inference service unavailable: {e}"}
+        self.requests += 1
+        self.total_latency += time.perf_counter() - start
+        if status != 200:
+            self.failures += 1
+            payload.setdefault('error', f"Inference service returned HTTP {status}.")
+            payload['retryable'] = True  # Not a property of the frame, so callers should not cache it
+        return frame_bgr, payload
+
+    def recognize(self, frame_bgr, profile='accurate', visualize=True, frame_owned=False):
+        """(results, visualized_frame) like run_recognition_pipeline; with visualize=False, (results, None) with results['circles'] kept."""
+        if frame_bgr is None: return {'error': "Input frame is None."}, None
+        frame_bgr, results = self._post_frame('/recognize', frame_bgr, profile, copy=visualize and not frame_owned)
+        if not visualize: return results, None
+        circles = results.pop('circles', None)
+        if circles: draw_detected_circles(frame_bgr, np.array([circles], dtype=np.float32))
+        return results, frame_bgr
+
+    def count(self, frame_bgr, profile='accurate', frame_owned=False):
+        if frame_bgr is None: return {'error': "Input frame is None."}, None
+        frame_bgr, results = self._post_frame('/count', frame_bgr, profile, copy=not frame_owned)
+        results.setdefault('coins', []); results.setdefault('coin_count', 0); results.setdefault('total_value', 0.0)
+        coins = results['coins']
+        if coins:
+            draw_detected_circles(frame_bgr, np.array([[coin['circle'] for coin in coins]], dtype=np.float32))
+            for coin in coins:
+                x, y, _ = coin['circle']
+                cv2.putText(frame_bgr, coin['coin_type'], (int(x) - 15, int(y) + 5), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 2)
+        return results, frame_bgr
+
+    def stats(self):
+        return {'requests': self.requests, 'failures': self.failures,
+                'mean_latency_ms': self.total_latency / self.requests * 1000 if self.requests else 0.0}
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None: self._connection.close(); self._connection = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve coin recognition over HTTP with request micro-batching.")
+    parser.add_argument('--host', default='127.0.0.1', help="Interface to bind (default 127.0.0.1; use 0.0.0.0 to serve other stations).")
+    parser.add_argument('--port', type=int, default=8765, help="Port (default 8765).")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="Feature extraction processes (default: CPU count).")
+    parser.add_argument('--max-batch-size', type=int, default=16, help="Most requests scored by one classifier call (default 16).")
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help="Longest a request waits for others to batch with (default 5 ms).")
+    parser.add_argument('--max-queue', type=int, default=256, help="Queued requests beyond which the service answers 503 (default 256).")
+    parser.add_argument('--profile', choices=PREPROCESS_PROFILES, default='accurate', help="Default preprocessing profile (default accurate).")
+    parser.add_argument('--crop-roi', action='store_true', help="Extract features on the coin's bounding box (only for models trained that way).")
+    args = parser.parse_args(argv)
+
+    from model_loader import load_prediction_assets, model_fingerprint
+    assets = load_prediction_assets()
+    if not all(a is not None for a in assets):
+        print("Prediction assets failed to load.", file=sys.stderr)
+        return 1
+    service = InferenceService(assets, model_fingerprint(), args.workers, args.max_batch_size, args.max_wait_ms, args.max_queue,
+                               profile=args.profile, crop_roi=args.crop_roi)
+
+    async def run():
+        host, port = await service.start(args.host, args.port)
+        print(f"Serving coin recognition at http://{host}:{port} with {service.workers} workers (Ctrl+C to stop).", file=sys.stderr)
+        try:
+            await service.serve_forever()
+        finally:
+            await service.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,27 +10,79 @@ from kivy.uix.button import Button
 from kivy.uix.textinput import TextInput
 from kivy.uix.checkbox import CheckBox
 from kivy.clock import Clock
-from kivy.graphics.texture import Texture
+from kivy.graphics import Color, Ellipse, Line
 from kivy.logger import Logger
+from functools import partial
+import os
+import threading
 import cv2
 import numpy as np
 
-from model_loader import load_prediction_assets
-from image_processing_pipeline import run_recognition_pipeline
+from model_loader import load_prediction_assets, model_fingerprint
+from image_processing_pipeline import run_recognition_pipeline, run_multi_coin_pipeline
+from recognition_worker import RecognitionWorker
+from temporal_tracking import CoinTracker
+from camera_capture import ThreadedCapture
+from preview_texture import PreviewTexture
+from pipeline_profiler import PROFILER
+from result_cache import ResultCache
+from inference_service import InferenceClient
+
+# Live recognition trades a little accuracy for frame rate; single captures use the full-quality denoising.
+LIVE_PREPROCESS_PROFILE = 'fast'
+CAPTURE_PREPROCESS_PROFILE = 'accurate'
+# Stages shown in the profiling overlay (COIN_PIPELINE_PROFILE=1) and the snapshot written on exit.
+PROFILE_OVERLAY_STAGES = ['total', 'preprocess', 'segment', 'features', 'lbp', 'hog', 'color', 'classify']
+PROFILE_SNAPSHOT_PATH = 'pipeline_profile.json'
+# Set to e.g. http://192.168.1.10:8765 to recognize on a shared inference_service.py instead of loading the models locally.
+INFERENCE_URL = os.environ.get('COIN_INFERENCE_URL')
 
 class CoinRecognizerApp(App):
     def build(self):
         self.title = "SA Coin Recognizer"
         self.assets_loaded = False
+        self.assets_loading = True
         self.scaler, self.feature_names, self.type_clf, self.side_clf = None, None, None, None
         self.app_mode = 'connecting'
         self.capture = None
+        self.last_frame_seq = 0
         self.processing_active = False
-        self.frame_to_process = None
+        self.recognition_worker = None
+        self.tracker = None
+        self.profile_label = None
+        self.result_cache = None
+        self.live_circles = None
+        self.preview = PreviewTexture()
+        self.remote_backend = InferenceClient(INFERENCE_URL) if INFERENCE_URL else None
         self.root_layout = BoxLayout(orientation='vertical')
         self.setup_connection_screen()
+        # Models load while the user picks a camera, so the main screen can open as soon as it connects.
+        threading.Thread(target=self._load_assets_in_background, name='AssetLoader', daemon=True).start()
         return self.root_layout
 
+    def _load_assets_in_background(self):
+        if self.remote_backend:
+            Clock.schedule_once(partial(self.on_backend_checked, self.remote_backend.health()))
+            return
+        assets = load_prediction_assets()
+        Clock.schedule_once(partial(self.on_assets_loaded, assets))
+
+    def on_backend_checked(self, health, dt):
+        self.assets_loading = False
+        self.assets_loaded = health is not None
+        if self.assets_loaded:
+            Logger.info(f"App: Using inference service at {INFERENCE_URL} (models {health['model_fingerprint']}).")
+            self.result_cache = ResultCache(health['model_fingerprint'], max_entries=16)
+        else: Logger.error(f"App: Inference service at {INFERENCE_URL} is unreachable.")
+        if self.app_mode != 'connecting': self._update_model_status()
+
+    def on_assets_loaded(self, assets, dt):
+        self.scaler, self.feature_names, self.type_clf, self.side_clf = assets
+        self.assets_loading = False
+        self.assets_loaded = all(a is not None for a in assets)
+        if self.assets_loaded: self.result_cache = ResultCache(model_fingerprint(), max_entries=16)
+        if self.app_mode != 'connecting': self._update_model_status()
+
     def setup_connection_screen(self):
         self.root_layout.clear_widgets()
         conn_layout = BoxLayout(orientation='vertical', spacing=10, padding=40)
@@ -80,55 +132,122 @@ class CoinRecognizerApp(App):
 
     def init_camera(self, source):
         try:
-            if isinstance(source, int): self.capture = cv2.VideoCapture(source);_ = self.capture.isOpened() or setattr(self, 'capture', cv2.VideoCapture(1))
-            elif isinstance(source, str): self.capture = cv2.VideoCapture(source)
+            if self.capture: self.capture.release()
+            if isinstance(source, int): self.capture = ThreadedCapture(source);_ = self.capture.open() or setattr(self, 'capture', ThreadedCapture(1)) or self.capture.open()
+            elif isinstance(source, str): self.capture = ThreadedCapture(source); self.capture.open()
             else: return False
             return self.capture.isOpened()
         except Exception as e: Logger.error(f"App: Camera init exception: {e}"); self.capture = None; return False
 
+    @property
+    def frame_to_process(self):
+        """Newest camera frame from the capture thread's ring buffer (not a copy), or None."""
+        return self.capture.latest()[0] if self.capture else None
+
     def load_models_and_setup_main_screen(self):
-        self.scaler, self.feature_names, self.type_clf, self.side_clf = load_prediction_assets()
-        if all([self.scaler, self.feature_names, self.type_clf, self.side_clf]): self.assets_loaded = True; self.setup_main_app_screen()
+        # Loading started at launch; the main screen shows progress until on_assets_loaded runs.
+        self.setup_main_app_screen()
+
+    def _update_model_status(self):
+        """Enables recognition once the models are in, and starts the live recognition worker the first time."""
+        for button in [self.live_button, self.capture_button, self.count_button]: button.disabled = not self.assets_loaded
+        if self.assets_loaded:
+            if self.recognition_worker is None:
+                if self.remote_backend:
+                    self.recognition_worker = RecognitionWorker(self._recognize_remote_frame, self._post_recognition_result).start()
+                else:
+                    # Live circles are drawn over the camera preview, so the tracker skips drawing a 300x300 visualization
+                    self.tracker = CoinTracker(self.scaler, self.type_clf, self.side_clf, self.feature_names, profile=LIVE_PREPROCESS_PROFILE, visualize=False)
+                    self.recognition_worker = RecognitionWorker(self._track_frame, self._post_recognition_result).start()
+            if self.status_label.text == "Loading models...": self.status_label.text = "Ready."
+        elif self.assets_loading: self.status_label.text = "Loading models..."
+        elif self.remote_backend: self.status_label.text = "Error: Inference service unreachable."
+        else: self.status_label.text = "Error: AI Models failed to load."
 
     def setup_main_app_screen(self):
         self.root_layout.clear_widgets()
         self.app_mode = 'live'
         main_layout = self.create_main_app_layout()
         self.root_layout.add_widget(main_layout)
+        self._update_model_status()
         Clock.schedule_interval(self.update_camera_feed, 1.0 / 30.0)
-        Clock.schedule_interval(self.process_frame_if_active, 0.5)
 
     def create_main_app_layout(self):
         layout = BoxLayout(orientation='vertical', spacing=10, padding=10)
         self.camera_view = KivyImage(fit_mode="fill")
+        self.camera_view.bind(pos=self._draw_live_circles, size=self._draw_live_circles)
         layout.add_widget(self.camera_view)
         self.status_label = Label(text="Ready.", size_hint_y=None, height=35)
         self.type_label = Label(text="Coin Type: N/A", font_size='20sp', size_hint_y=None, height=40)
         self.side_label = Label(text="Coin Side: N/A", font_size='20sp', size_hint_y=None, height=40)
         self.confidence_label = Label(text="Confidence: N/A", size_hint_y=None, height=30)
         for widget in [self.status_label, self.type_label, self.side_label, self.confidence_label]: layout.add_widget(widget)
+        if PROFILER.enabled:
+            self.profile_label = Label(text="Profiling...", font_size='12sp', size_hint_y=None, height=20 * len(PROFILE_OVERLAY_STAGES), halign='left', valign='top')
+            self.profile_label.bind(size=self.profile_label.setter('text_size'))
+            layout.add_widget(self.profile_label)
+            Clock.unschedule(self.update_profile_overlay); Clock.schedule_interval(self.update_profile_overlay, 1.0)
         button_box = BoxLayout(orientation='horizontal', size_hint_y=None, height=60, spacing=10)
         self.live_button = Button(text="Start Live Rec", on_press=self.toggle_processing)
         self.capture_button = Button(text="Capture & Predict", on_press=self.capture_and_predict)
+        self.count_button = Button(text="Count Coins", on_press=self.capture_and_count)
         self.back_button = Button(text="Back to Live", on_press=self.go_back_to_live, disabled=True)
-        for widget in [self.live_button, self.capture_button, self.back_button]: button_box.add_widget(widget)
+        for widget in [self.live_button, self.capture_button, self.count_button, self.back_button]: button_box.add_widget(widget)
         layout.add_widget(button_box)
         return layout
 
     def display_frame(self, frame):
-        buf = cv2.flip(frame, 0).tobytes(); texture = Texture.create(size=(frame.shape[1], frame.shape[0]), colorfmt='bgr'); texture.blit_buffer(buf, colorfmt='bgr', bufferfmt='ubyte'); self.camera_view.texture = texture
+        texture = self.preview.upload(frame)
+        # Re-blitting a texture the widget already shows does not trigger a redraw on its own
+        if self.camera_view.texture is texture: self.camera_view.canvas.ask_update()
+        else: self.camera_view.texture = texture
 
     def capture_and_predict(self, instance):
         Logger.info("APP: 'Capture & Predict' button pressed.")
-        if self.frame_to_process is None: return
+        frame = self.frame_to_process
+        if frame is None: return
         self.app_mode = 'captured'
         self.processing_active = False
+        if self.recognition_worker: self.recognition_worker.cancel_pending()
+        self._set_live_circles(None)
         self.live_button.disabled = True
         self.capture_button.disabled = True
+        self.count_button.disabled = True
         self.back_button.disabled = False
         self.status_label.text = "Processing captured image..."
-        processed_image = self.run_prediction_pipeline(self.frame_to_process)
+        processed_image = self.run_prediction_pipeline(frame)
         if processed_image is not None: self.display_frame(processed_image)
+
+    def capture_and_count(self, instance):
+        Logger.info("APP: 'Count Coins' button pressed.")
+        frame = self.frame_to_process
+        if frame is None: return
+        if not self.assets_loaded:
+            self.status_label.text = "Error: AI Models are not loaded."
+            return
+        self.app_mode = 'captured'
+        self.processing_active = False
+        if self.recognition_worker: self.recognition_worker.cancel_pending()
+        self._set_live_circles(None)
+        self.live_button.disabled = True
+        self.capture_button.disabled = True
+        self.count_button.disabled = True
+        self.back_button.disabled = False
+        if self.remote_backend: count_fn = lambda f: self.remote_backend.count(f, CAPTURE_PREPROCESS_PROFILE, frame_owned=True)
+        else: count_fn = lambda f: run_multi_coin_pipeline(f, self.scaler, self.type_clf, self.side_clf, self.feature_names, profile=CAPTURE_PREPROCESS_PROFILE,
+                                                           frame_owned=True)
+        results, visualized_frame = self._cached_run(frame, count_fn, pipeline='multi_coin', profile=CAPTURE_PREPROCESS_PROFILE)
+        Logger.info(f"PIPELINE RESULTS (multi-coin): {results}")
+        self._reset_prediction_labels()
+        if results.get('error'):
+            self.status_label.text = f"Status: {results['error']}"
+        else:
+            self.status_label.text = f"Counted {results['coin_count']} coin(s)"
+            self.type_label.text = "Coins: " + ", ".join(coin['coin_type'] for coin in results['coins'])
+            self.side_label.text = f"Total: R{results['total_value']:.2f}"
+            unknown = sum(coin['value'] is None for coin in results['coins'])
+            if unknown: self.confidence_label.text = f"{unknown} coin(s) without a known value"
+        if visualized_frame is not None: self.display_frame(visualized_frame)
     
     def _reset_prediction_labels(self):
         self.type_label.text = "Coin Type: N/A"
@@ -140,22 +259,60 @@ class CoinRecognizerApp(App):
         self.app_mode = 'live'
         self.live_button.disabled = False
         self.capture_button.disabled = False
+        self.count_button.disabled = False
         self.back_button.disabled = True
         self.status_label.text = "Ready."
         self._reset_prediction_labels()
 
+    def _cached_run(self, frame, run_fn, **options):
+        """
+        Runs run_fn on the frame resized to the pipeline's 300x300, reusing the cached (results, visualized_frame)
+        when the same resized frame was processed with the same options and models, e.g. re-capturing a paused scene.
+        The resized frame is handed to run_fn with frame_owned=True, so it is not copied again and becomes the visualized frame.
+        """
+        frame = cv2.resize(frame, (300, 300), interpolation=cv2.INTER_AREA)  # Also snapshots the frame off the capture buffer
+        key = self.result_cache.key(frame, **options) if self.result_cache else None
+        cached = self.result_cache.get(key) if key else None
+        if cached is not None:
+            Logger.info(f"PIPELINE: Reusing cached result for an identical frame ({self.result_cache.stats()['hits']} cache hits).")
+            return cached
+        output = run_fn(frame)
+        if key and not output[0].get('retryable'): self.result_cache.put(key, output)
+        return output
+
+    def _run_pipeline(self, frame, profile=CAPTURE_PREPROCESS_PROFILE):
+        """Runs recognition on a frame without touching any widgets, so it is safe to call from the worker thread."""
+        Logger.info(f"PIPELINE: Running prediction ({profile} preprocessing)...")
+        if self.remote_backend: run_fn = lambda f: self.remote_backend.recognize(f, profile, frame_owned=True)
+        else: run_fn = lambda f: run_recognition_pipeline(f, self.scaler, self.type_clf, self.side_clf, self.feature_names, profile=profile, frame_owned=True)
+        results, visualized_frame = self._cached_run(frame, run_fn, pipeline='single', profile=profile)
+        
+        #Logging of the results dictionary.
+        Logger.info(f"PIPELINE RESULTS: {results}")
+        return results, visualized_frame
+
+    def _track_frame(self, frame):
+        """Live recognition step on the worker thread: reuses the last prediction while the coin stays still. Returns (results, circles)."""
+        results, _ = self.tracker.process(frame)
+        if self.tracker.last_decision != 'reused': Logger.info(f"PIPELINE RESULTS ({self.tracker.last_decision}): {results}")
+        return results, self.tracker.circles
+
+    def _recognize_remote_frame(self, frame):
+        """Live recognition step on the worker thread when using the inference service. Returns (results, circles)."""
+        results, _ = self.remote_backend.recognize(frame, LIVE_PREPROCESS_PROFILE, visualize=False)
+        return results, results.pop('circles', None)
+
     # <<< MODIFIED: This function has the core changes. ---
     def run_prediction_pipeline(self, frame):
         if not self.assets_loaded:
             self.status_label.text = "Error: AI Models are not loaded."
             return None
         
-        Logger.info("PIPELINE: Running prediction...")
-        results, visualized_frame = run_recognition_pipeline(frame.copy(), self.scaler, self.type_clf, self.side_clf, self.feature_names)
-        
-        #Logging of the results dictionary.
-        Logger.info(f"PIPELINE RESULTS: {results}")
+        results, visualized_frame = self._run_pipeline(frame)
+        self._show_prediction_results(results)
+        return visualized_frame
 
+    def _show_prediction_results(self, results):
         if results:
             if results.get('error'):
                 self.status_label.text = f"Status: {results['error']}"
@@ -170,31 +327,78 @@ class CoinRecognizerApp(App):
         else:
             self.status_label.text = "Status: Pipeline returned no results."
             self._reset_prediction_labels()
-            
-        return visualized_frame
 
     def toggle_processing(self, instance):
         self.processing_active = not self.processing_active
+        if self.processing_active and self.tracker: self.tracker.reset()
         instance.text = "Stop Live Rec" if self.processing_active else "Start Live Rec"
         self.capture_button.disabled = self.processing_active
+        self.count_button.disabled = self.processing_active
         if not self.processing_active:
+            if self.recognition_worker: self.recognition_worker.cancel_pending()
+            self._set_live_circles(None)
             self.status_label.text = "Live recognition paused."
             self._reset_prediction_labels()
 
     def update_camera_feed(self, dt):
         if self.app_mode != 'live' or not self.capture or not self.capture.isOpened(): return
-        ret, frame = self.capture.read()
-        if ret:
-            self.frame_to_process = frame
-            if not self.processing_active: self.display_frame(self.frame_to_process)
+        frame, seq = self.capture.latest()
+        if frame is not None and seq != self.last_frame_seq:
+            self.last_frame_seq = seq
+            self.display_frame(frame)
+            if self.processing_active and self.assets_loaded: self.recognition_worker.submit(frame)
+
+    def _set_live_circles(self, circles):
+        """Shows circles (in the pipeline's 300x300 frame coordinates) over the live preview; None clears them."""
+        self.live_circles = None if circles is None else np.asarray(circles, dtype=np.float32).reshape(-1, 3)
+        self._draw_live_circles()
+
+    def _draw_live_circles(self, *args):
+        # Drawn as canvas instructions over the preview texture, so camera frames are never copied to draw on.
+        # With fit_mode="fill" the 300x300 pipeline frame and the camera frame both stretch over the whole widget.
+        view = self.camera_view
+        view.canvas.after.clear()
+        if self.live_circles is None: return
+        sx, sy = view.width / 300.0, view.height / 300.0
+        with view.canvas.after:
+            for x, y, r in self.live_circles:
+                cx, cy = view.x + x * sx, view.top - y * sy
+                Color(0, 1, 0); Line(ellipse=(cx - r * sx, cy - r * sy, 2 * r * sx, 2 * r * sy), width=2)
+                Color(1, 0, 0); Ellipse(pos=(cx - 3, cy - 3), size=(6, 6))
+
+    def update_profile_overlay(self, dt):
+        if self.profile_label: self.profile_label.text = PROFILER.summary_text(PROFILE_OVERLAY_STAGES) or "Profiling..."
+
+    def _post_recognition_result(self, result, frame, elapsed):
+        # Called on the worker thread; widgets may only be touched from the Kivy main thread.
+        results, circles = result
+        Clock.schedule_once(partial(self.on_recognition_result, results, circles, elapsed))
 
-    def process_frame_if_active(self, dt):
-        if self.processing_active and self.app_mode == 'live' and self.frame_to_process is not None:
-            processed_image = self.run_prediction_pipeline(self.frame_to_process)
-            if processed_image is not None: self.display_frame(processed_image)
+    def on_recognition_result(self, results, circles, elapsed, dt):
+        if not self.processing_active or self.app_mode != 'live': return  # Stale result from before a pause or capture
+        self._show_prediction_results(results)
+        self._set_live_circles(circles)
+        if results and not results.get('error'):
+            self.status_label.text = f"Recognizing... ({1.0 / elapsed:.1f} fps)" if elapsed > 0 else "Recognizing..."
 
     def on_stop(self):
-        if self.capture: self.capture.release()
+        if self.recognition_worker: self.recognition_worker.stop()
+        if self.tracker: Logger.info(f"App: Live recognition decisions: {self.tracker.counters}")
+        if self.tracker: Logger.info(f"App: Live segmentation searches: {self.tracker.segmenter.stats()}")
+        if self.result_cache: Logger.info(f"App: Result cache: {self.result_cache.stats()}")
+        Logger.info(f"App: Preview uploads: {self.preview.stats()}")
+        if self.remote_backend:
+            Logger.info(f"App: Inference service requests: {self.remote_backend.stats()}")
+            self.remote_backend.close()
+        if self.capture:
+            Logger.info(f"App: Capture stats: {self.capture.stats()}")
+            self.capture.release()
+        if PROFILER.enabled:
+            Logger.info(f"App: Pipeline stage latency:\n{PROFILER.summary_text()}")
+            try:
+                with open(PROFILE_SNAPSHOT_PATH, 'w') as f: f.write(PROFILER.to_json())
+            except OSError as e:
+                Logger.warning(f"App: Could not write profile snapshot: {e}")
 
 if __name__ == '__main__':
     CoinRecognizerApp().run()
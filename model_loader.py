@@ -1,7 +1,10 @@
+import hashlib
 import joblib
 import json
 from pathlib import Path
 from kivy.logger import Logger
+from image_processing_pipeline import compile_feature_layout
+from compact_models import load_compact_assets, source_fingerprint
 
 MODEL_DIR_NAME = 'models_final'
 try:
@@ -21,6 +24,7 @@ TYPE_MODEL_FILENAME = "random_forest_type_model.joblib"
 SIDE_MODEL_FILENAME = "random_forest_side_model.joblib"
 SCALER_FILENAME = "scaler.joblib"
 FEATURE_NAMES_FILENAME = "feature_names.json"
+COMPACT_DIR_NAME = "compact"  # Memory-mapped export written by compact_models.py
 
 SCALER_PATH = MODEL_DIR / SCALER_FILENAME
 FEATURE_NAMES_PATH = MODEL_DIR / FEATURE_NAMES_FILENAME
@@ -28,52 +32,94 @@ TYPE_MODEL_PATH = MODEL_DIR / TYPE_MODEL_FILENAME
 SIDE_MODEL_PATH = MODEL_DIR / SIDE_MODEL_FILENAME
 
 
-def load_prediction_assets():
-    """Loads the scaler, feature names, and trained models."""
-    Logger.info(f"ModelLoader: Attempting to load assets from: {MODEL_DIR}")
+def model_source_fingerprint(model_dir=None):
+    """Size and modification time of each model file, used to tell whether the compact export is current."""
+    return source_fingerprint(model_dir or MODEL_DIR, [SCALER_FILENAME, FEATURE_NAMES_FILENAME, TYPE_MODEL_FILENAME, SIDE_MODEL_FILENAME])
+
+
+def model_fingerprint(model_dir=None):
+    """Short hash identifying the current model files; changes whenever any of them is replaced. Used to key cached results."""
+    fingerprint = json.dumps(model_source_fingerprint(model_dir), sort_keys=True)
+    return hashlib.sha1(fingerprint.encode()).hexdigest()[:16]
+
+
+def _load_compact_prediction_assets(model_dir):
+    """Returns the compact, memory-mapped assets if an up-to-date export exists, else None."""
+    compact_dir = Path(model_dir) / COMPACT_DIR_NAME
+    if not compact_dir.exists(): return None
+    try:
+        assets = load_compact_assets(compact_dir, sources=model_source_fingerprint(model_dir))
+    except Exception as e:
+        Logger.error(f"ModelLoader: Error loading compact models from {compact_dir}: {e}")
+        return None
+    if assets is None:
+        Logger.warning(f"ModelLoader: Compact models in {compact_dir} are out of date; re-run compact_models.py. Using joblib models.")
+        return None
+    compile_feature_layout(assets[1])
+    Logger.info(f"ModelLoader: Compact models memory-mapped from {compact_dir}")
+    return assets
+
+
+def load_prediction_assets(model_dir=None, prefer_compact=True):
+    """
+    Loads the scaler, feature names, and trained models from model_dir (default: models_final).
+    With prefer_compact, an up-to-date export in <model_dir>/compact is memory-mapped instead of unpickling the joblib files.
+    """
+    if model_dir is None:
+        model_dir, scaler_path, feature_names_path, type_model_path, side_model_path = MODEL_DIR, SCALER_PATH, FEATURE_NAMES_PATH, TYPE_MODEL_PATH, SIDE_MODEL_PATH
+    else:
+        model_dir = Path(model_dir)
+        scaler_path, feature_names_path = model_dir / SCALER_FILENAME, model_dir / FEATURE_NAMES_FILENAME
+        type_model_path, side_model_path = model_dir / TYPE_MODEL_FILENAME, model_dir / SIDE_MODEL_FILENAME
+    Logger.info(f"ModelLoader: Attempting to load assets from: {model_dir}")
     assets = {'scaler': None, 'feature_names': None, 'type_clf': None, 'side_clf': None}
     all_loaded = True
 
-    if not MODEL_DIR.exists():
-        Logger.error(f"ModelLoader: CRITICAL - Model directory not found at {MODEL_DIR}")
+    if not model_dir.exists():
+        Logger.error(f"ModelLoader: CRITICAL - Model directory not found at {model_dir}")
         return None, None, None, None
 
+    if prefer_compact:
+        compact_assets = _load_compact_prediction_assets(model_dir)
+        if compact_assets is not None: return compact_assets
+
     try:
-        assets['scaler'] = joblib.load(SCALER_PATH)
-        Logger.info(f"ModelLoader: Scaler loaded from {SCALER_PATH}")
+        assets['scaler'] = joblib.load(scaler_path)
+        Logger.info(f"ModelLoader: Scaler loaded from {scaler_path}")
     except FileNotFoundError:
-        Logger.error(f"ModelLoader: CRITICAL - Scaler file not found at {SCALER_PATH}")
+        Logger.error(f"ModelLoader: CRITICAL - Scaler file not found at {scaler_path}")
         all_loaded = False
     except Exception as e:
         Logger.error(f"ModelLoader: CRITICAL - Error loading scaler: {e}")
         all_loaded = False
 
     try:
-        with open(FEATURE_NAMES_PATH, 'r') as f:
+        with open(feature_names_path, 'r') as f:
             assets['feature_names'] = json.load(f)
-        Logger.info(f"ModelLoader: Feature names loaded from {FEATURE_NAMES_PATH}")
+        compile_feature_layout(assets['feature_names'])  # Compiled once here; the pipeline reuses it every frame
+        Logger.info(f"ModelLoader: Feature names loaded from {feature_names_path}")
     except FileNotFoundError:
-        Logger.error(f"ModelLoader: CRITICAL - Feature names file not found at {FEATURE_NAMES_PATH}")
+        Logger.error(f"ModelLoader: CRITICAL - Feature names file not found at {feature_names_path}")
         all_loaded = False
     except Exception as e:
         Logger.error(f"ModelLoader: CRITICAL - Error loading feature names: {e}")
         all_loaded = False
 
     try:
-        assets['type_clf'] = joblib.load(TYPE_MODEL_PATH)
-        Logger.info(f"ModelLoader: Type classifier ('{TYPE_MODEL_FILENAME}') loaded from {TYPE_MODEL_PATH}")
+        assets['type_clf'] = joblib.load(type_model_path)
+        Logger.info(f"ModelLoader: Type classifier ('{TYPE_MODEL_FILENAME}') loaded from {type_model_path}")
     except FileNotFoundError:
-        Logger.error(f"ModelLoader: CRITICAL - Type model file ('{TYPE_MODEL_FILENAME}') not found at {TYPE_MODEL_PATH}")
+        Logger.error(f"ModelLoader: CRITICAL - Type model file ('{TYPE_MODEL_FILENAME}') not found at {type_model_path}")
         all_loaded = False
     except Exception as e:
         Logger.error(f"ModelLoader: CRITICAL - Error loading type model: {e}")
         all_loaded = False
 
     try:
-        assets['side_clf'] = joblib.load(SIDE_MODEL_PATH)
-        Logger.info(f"ModelLoader: Side classifier ('{SIDE_MODEL_FILENAME}') loaded from {SIDE_MODEL_PATH}")
+        assets['side_clf'] = joblib.load(side_model_path)
+        Logger.info(f"ModelLoader: Side classifier ('{SIDE_MODEL_FILENAME}') loaded from {side_model_path}")
     except FileNotFoundError:
-        Logger.error(f"ModelLoader: CRITICAL - Side model file ('{SIDE_MODEL_FILENAME}') not found at {SIDE_MODEL_PATH}")
+        Logger.error(f"ModelLoader: CRITICAL - Side model file ('{SIDE_MODEL_FILENAME}') not found at {side_model_path}")
         all_loaded = False
     except Exception as e:
         Logger.error(f"ModelLoader: CRITICAL - Error loading side model: {e}")
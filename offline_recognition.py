@@ -0,0 +1,193 @@
+"""
+Headless, multi-core recognition over a directory or list of coin images.
+
+Usage:
+    python -m offline_recognition images/ -o results.csv --workers 8
+    python -m offline_recognition a.jpg b.jpg @more_files.txt -o results.jsonl --unordered
+    python -m offline_recognition images/ -o results.csv --cache results_cache.sqlite
+"""
+import os
+os.environ.setdefault('KIVY_NO_ARGS', '1')  # Keep Kivy from parsing this CLI's arguments
+
+import argparse
+import csv
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import cv2
+from image_processing_pipeline import PREPROCESS_PROFILES
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp'}
+RESULT_FIELDS = ['path', 'coin_type', 'coin_side', 'type_confidence', 'side_confidence', 'error']
+
+_worker_assets = None
+_worker_cache = None
+
+
+def collect_image_paths(inputs):
+    """Expands directories, image files and @list files (one path per line) into image paths."""
+    paths = []
+    for item in inputs:
+        if item.startswith('@'):
+            with open(item[1:], 'r') as f:
+                paths.extend(line.strip() for line in f if line.strip())
+            continue
+        path = Path(item)
+        if path.is_dir():
+            paths.extend(str(p) for p in sorted(path.rglob('*')) if p.suffix.lower() in IMAGE_EXTENSIONS)
+        else:
+            paths.append(str(path))
+    return paths
+
+
+def _init_worker(cache_path=None, cache_size=100000):
+    """Process-pool initializer: loads the prediction assets once per worker and opens the shared result cache."""
+    global _worker_assets, _worker_cache
+    from model_loader import load_prediction_assets, model_fingerprint
+    cv2.setNumThreads(1)  # Parallelism comes from the pool; avoid oversubscribing cores
+    assets = load_prediction_assets()
+    _worker_assets = assets if all(a is not None for a in assets) else None
+    if cache_path and _worker_assets is not None:
+        from result_cache import ResultCache
+        _worker_cache = ResultCache(model_fingerprint(), max_entries=1024, db_path=cache_path, max_disk_entries=cache_size)
+
+
+def _process_chunk(paths, profile='accurate', crop_roi=False):
+    """
+    Recognizes one chunk of image paths in a worker and returns one record per path. Images already
+    in the result cache are not recomputed; their records carry cached=True.
+    """
+    from image_processing_pipeline import run_recognition_batch
+    if _worker_assets is None:
+        raise RuntimeError("Prediction assets failed to load in worker process.")
+    scaler, feature_names, type_clf, side_clf = _worker_assets
+    frames = [cv2.imread(p) for p in paths]
+    records = [None] * len(paths)
+    keys = {}
+    pending = []
+    for i, (path, frame) in enumerate(zip(paths, frames)):
+        if frame is None:
+            records[i] = {'path': path, **{k: None for k in RESULT_FIELDS[1:]}, 'error': "Could not read image."}
+            continue
+        if _worker_cache is not None:
+            # The pipeline resizes to 300x300 first, so hashing the resized frame keys exactly what gets recognized
+            frames[i] = cv2.resize(frame, (300, 300), interpolation=cv2.INTER_AREA)
+            keys[i] = _worker_cache.key(frames[i], profile=profile, crop_roi=crop_roi)
+            cached = _worker_cache.get(keys[i])
+            if cached is not None:
+                records[i] = {'path': path, **cached, 'cached': True}
+                continue
+        pending.append(i)
+    results, _ = run_recognition_batch([frames[i] for i in pending], scaler, type_clf, side_clf, feature_names, visualize=False, profile=profile, crop_roi=crop_roi)
+    for i, result in zip(pending, results):
+        values = {k: result.get(k) for k in RESULT_FIELDS[1:]}
+        if i in keys: _worker_cache.put(keys[i], values)
+        records[i] = {'path': paths[i], **values}
+    return records
+
+
+def chunked(items, size):
+    """Yields consecutive slices of at most size items."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def iter_recognition_results(paths, workers=None, chunk_size=16, ordered=True, max_pending=None, profile='accurate', crop_roi=False,
+                             cache_path=None, cache_size=100000):
+    """
+    Fans image paths out over a process pool in chunks and yields result records.
+    At most max_pending chunks are in flight at once, so memory stays bounded for large
+    inputs. ordered=False yields chunks as soon as they finish instead of in input order.
+    With cache_path, results are looked up in and added to a SQLite result cache shared by
+    the workers; records served from it carry cached=True.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 4
+    chunks = chunked(list(paths), max(1, chunk_size))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(cache_path, cache_size)) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_process_chunk, chunk, profile, crop_roi))
+            while len(pending) >= max_pending:
+                if ordered:
+                    yield from pending.popleft().result()
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                        yield from future.result()
+        if ordered:
+            while pending:
+                yield from pending.popleft().result()
+        else:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield from future.result()
+
+
+class ResultWriter:
+    """Writes result records as CSV or JSONL."""
+    def __init__(self, stream, fmt, fieldnames=RESULT_FIELDS):
+        self.stream = stream
+        self.fmt = fmt
+        if fmt == 'csv':
+            self.csv_writer = csv.DictWriter(stream, fieldnames=fieldnames)
+            self.csv_writer.writeheader()
+
+    def write(self, record):
+        if self.fmt == 'csv': self.csv_writer.writerow(record)
+        else: self.stream.write(json.dumps(record) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m offline_recognition', description="Run coin recognition over image files using all CPU cores.")
+    parser.add_argument('inputs', nargs='+', help="Image files, directories (searched recursively) or @file lists with one path per line.")
+    parser.add_argument('-o', '--output', default='-', help="Output file (.csv or .jsonl). Defaults to stdout.")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help="Output format. Inferred from the output extension if omitted (default csv).")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="Worker processes (default: CPU count).")
+    parser.add_argument('--chunk-size', type=int, default=16, help="Images per task sent to a worker (default 16).")
+    parser.add_argument('--profile', choices=PREPROCESS_PROFILES, default='accurate', help="Preprocessing profile (default accurate).")
+    parser.add_argument('--crop-roi', action='store_true', help="Extract features on the coin's bounding box (only for models trained that way).")
+    parser.add_argument('--unordered', action='store_true', help="Write results as chunks complete instead of in input order.")
+    parser.add_argument('--cache', metavar='PATH', help="SQLite result cache; images recognized before with the same models are not recomputed.")
+    parser.add_argument('--cache-size', type=int, default=100000, help="Maximum number of cached results kept in the cache file (default 100000).")
+    args = parser.parse_args(argv)
+
+    paths = collect_image_paths(args.inputs)
+    if not paths:
+        print("No images found.", file=sys.stderr)
+        return 1
+    fmt = args.format or ('jsonl' if args.output.endswith(('.jsonl', '.json')) else 'csv')
+
+    stream = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    start = time.perf_counter()
+    processed = errors = cached = 0
+    try:
+        writer = ResultWriter(stream, fmt)
+        for record in iter_recognition_results(paths, workers=args.workers, chunk_size=args.chunk_size, ordered=not args.unordered, profile=args.profile,
+                                               crop_roi=args.crop_roi, cache_path=args.cache, cache_size=args.cache_size):
+            cached += record.pop('cached', False)
+            writer.write(record)
+            processed += 1
+            errors += record['error'] is not None
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if stream is not sys.stdout: stream.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Processed {processed} images in {elapsed:.2f}s ({processed / elapsed:.1f} images/s, "
+          f"{errors} with errors, {args.workers or os.cpu_count()} workers).", file=sys.stderr)
+    if args.cache: print(f"Result cache: {cached} of {processed} images served from {args.cache}.", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+import numpy as np
+
+_NULL_TIMER = nullcontext()
+
+
+class _StageTimer:
+    __slots__ = ('timings', 'stage', 'start')
+
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timings[self.stage] = self.timings.get(self.stage, 0.0) + (time.perf_counter() - self.start) * 1000
+
+
+def stage_timer(timings, stage):
+    """Context manager adding the elapsed milliseconds of a stage to timings. A shared no-op when timings is None."""
+    return _NULL_TIMER if timings is None else _StageTimer(timings, stage)
+
+
+class StageProfiler:
+    """
+    Rolling per-stage latency statistics for the recognition pipeline. While disabled, new_frame()
+    returns None and every stage_timer() is a shared no-op, so instrumented code pays almost nothing.
+    While enabled, each frame's {stage: ms} timings are kept in a window of the last `window` samples
+    per stage for p50/p95/p99, and cumulative counts and sums are kept for export.
+    """
+    QUANTILES = (50, 95, 99)
+
+    def __init__(self, enabled=False, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._totals = {}
+
+    def new_frame(self):
+        """Returns a fresh timings dict for one frame, or None when profiling is disabled."""
+        return {} if self.enabled else None
+
+    def record(self, timings):
+        if not timings: return
+        with self._lock:
+            for stage, ms in timings.items():
+                samples = self._samples.get(stage)
+                if samples is None:
+                    samples = self._samples[stage] = deque(maxlen=self.window)
+                    self._totals[stage] = [0, 0.0]
+                samples.append(ms)
+                self._totals[stage][0] += 1
+                self._totals[stage][1] += ms
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear(); self._totals.clear()
+
+    def snapshot(self):
+        """{stage: {'count', 'sum_ms', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms'}}, percentiles over the rolling window."""
+        with self._lock:
+            samples = {stage: np.fromiter(values, dtype=np.float64) for stage, values in self._samples.items()}
+            totals = {stage: tuple(total) for stage, total in self._totals.items()}
+        result = {}
+        for stage, values in samples.items():
+            percentiles = np.percentile(values, self.QUANTILES) if len(values) else [0.0] * len(self.QUANTILES)
+            count, total_ms = totals[stage]
+            result[stage] = {'count': count, 'sum_ms': total_ms, 'mean_ms': total_ms / count if count else 0.0,
+                             **{f'p{q}_ms': float(p) for q, p in zip(self.QUANTILES, percentiles)}}
+        return result
+
+    def to_json(self, indent=2):
+        return json.dumps({'timestamp': time.time(), 'stages': self.snapshot()}, indent=indent)
+
+    def to_prometheus(self, metric='coin_pipeline_stage_latency_ms'):
+        """Prometheus text exposition format: one summary per stage, quantiles over the rolling window."""
+        lines = [f"# HELP {metric} Recognition pipeline stage latency in milliseconds.", f"# TYPE {metric} summary"]
+        for stage, stats in self.snapshot().items():
+            for q in self.QUANTILES:
+                lines.append(f'{metric}{{stage="{stage}",quantile="{q / 100:g}"}} {stats[f"p{q}_ms"]:.6f}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {stats["sum_ms"]:.6f}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {stats["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def summary_text(self, stages=None):
+        """Short multi-line p50/p95/p99 summary, used by the on-screen overlay."""
+        snapshot = self.snapshot()
+        lines = []
+        for stage in stages or snapshot:
+            stats = snapshot.get(stage)
+            if stats: lines.append(f"{stage:<10} p50 {stats['p50_ms']:6.1f}  p95 {stats['p95_ms']:6.1f}  p99 {stats['p99_ms']:6.1f} ms")
+        return '\n'.join(lines)
+
+
+# Shared profiler used by image_processing_pipeline. Set COIN_PIPELINE_PROFILE=1 to enable it at start-up.
+PROFILER = StageProfiler(enabled=os.environ.get('COIN_PIPELINE_PROFILE', '') not in ('', '0'))
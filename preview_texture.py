@@ -0,0 +1,46 @@
+import numpy as np
+from kivy.graphics.texture import Texture
+
+
+class PreviewTexture:
+    """
+    Uploads BGR frames to the GPU for the live preview without per-frame allocations.
+
+    One texture is created per frame size (the camera resolution, plus 300x300 for visualized results) and
+    reused for every later frame of that size. OpenCV rows run top-down while GL textures run bottom-up, so each
+    texture's UV coordinates are flipped once at creation instead of flipping the pixels of every frame. Frames
+    are blitted straight from their own memory; a copy is only made when a frame is not contiguous or not
+    writable, as blit_buffer requires, and stats() reports how many bytes those copies cost per frame.
+    """
+    def __init__(self):
+        self._textures = {}
+        self.frames = 0
+        self.textures_created = 0
+        self.bytes_copied = 0
+        self.bytes_uploaded = 0
+        self.last_bytes_copied = 0
+
+    def upload(self, frame):
+        """Blits the frame into the texture for its size and returns that texture."""
+        height, width = frame.shape[:2]
+        texture = self._textures.get((width, height))
+        if texture is None:
+            texture = Texture.create(size=(width, height), colorfmt='bgr')
+            texture.flip_vertical()
+            self._textures[(width, height)] = texture
+            self.textures_created += 1
+        pixels = np.ascontiguousarray(frame)  # Returns the frame itself when it is already contiguous
+        if not pixels.flags.writeable: pixels = pixels.copy()
+        self.last_bytes_copied = 0 if pixels is frame else pixels.nbytes
+        texture.blit_buffer(memoryview(pixels.reshape(-1)), colorfmt='bgr', bufferfmt='ubyte')
+        self.frames += 1
+        self.bytes_copied += self.last_bytes_copied
+        self.bytes_uploaded += pixels.nbytes
+        return texture
+
+    def stats(self):
+        """Frames uploaded, textures created, and host-side bytes copied and uploaded per frame."""
+        frames = max(self.frames, 1)
+        return {'frames': self.frames, 'textures_created': self.textures_created,
+                'bytes_copied_per_frame': self.bytes_copied / frames, 'bytes_uploaded_per_frame': self.bytes_uploaded / frames,
+                'last_bytes_copied': self.last_bytes_copied}
@@ -0,0 +1,82 @@
+import threading
+import time
+from kivy.logger import Logger
+
+
+class LatestFrameSlot:
+    """Single-slot frame buffer. A new frame replaces any frame not yet taken, so a slow consumer only ever sees the newest one."""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._frame = None
+        self._closed = False
+        self.frames_put = 0
+        self.frames_dropped = 0
+
+    def put(self, frame):
+        with self._cond:
+            if self._frame is not None: self.frames_dropped += 1
+            self._frame = frame
+            self.frames_put += 1
+            self._cond.notify()
+
+    def take(self, timeout=None):
+        """Blocks until a frame is available and removes it. Returns None on timeout or once closed."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._frame is not None or self._closed, timeout): return None
+            frame, self._frame = self._frame, None
+            return frame
+
+    def clear(self):
+        with self._cond: self._frame = None
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class RecognitionWorker:
+    """
+    Runs process_fn(frame) on a background thread, always on the newest submitted frame.
+    Each result is handed to result_callback(result, frame, elapsed) from the worker thread,
+    so UI callers should hop back to their own thread (e.g. with Clock.schedule_once).
+    The recognition rate follows however fast process_fn runs; stale frames are dropped.
+    """
+    def __init__(self, process_fn, result_callback, name='RecognitionWorker'):
+        self.process_fn = process_fn
+        self.result_callback = result_callback
+        self.slot = LatestFrameSlot()
+        self.frames_processed = 0
+        self.last_latency = 0.0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, frame):
+        self.slot.put(frame)
+
+    def cancel_pending(self):
+        self.slot.clear()
+
+    def stop(self, timeout=2.0):
+        self.slot.close()
+        if self._thread.is_alive(): self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            frame = self.slot.take()
+            if frame is None: return  # Slot closed
+            start = time.perf_counter()
+            try:
+                result = self.process_fn(frame)
+            except Exception as e:
+                Logger.error(f"RecognitionWorker: Processing failed: {e}")
+                continue
+            self.last_latency = time.perf_counter() - start
+            self.frames_processed += 1
+            try:
+                self.result_callback(result, frame, self.last_latency)
+            except Exception as e:
+                Logger.error(f"RecognitionWorker: Result callback failed: {e}")
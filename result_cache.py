@@ -0,0 +1,114 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def frame_digest(frame):
+    """Fast content hash of a frame (normally the resized 300x300 BGR frame): BLAKE2b over shape, dtype and pixels."""
+    frame = np.ascontiguousarray(frame)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{frame.shape}{frame.dtype}'.encode())
+    digest.update(memoryview(frame).cast('B'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    LRU cache of recognition results keyed by frame content, pipeline options and a model fingerprint.
+
+    The in-memory tier keeps up to max_entries values of any type. With db_path, results are also kept
+    in a SQLite table of at most max_disk_entries rows (least recently used rows are evicted), so they
+    survive between runs and are shared by worker processes; values must then be JSON-serializable.
+    Rows written under a different model fingerprint are purged on open, so results never outlive the
+    models that produced them. Counters: hits (memory), disk_hits, misses, evictions, disk_evictions.
+    """
+    def __init__(self, fingerprint, max_entries=256, db_path=None, max_disk_entries=100000):
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._puts_since_trim = 0
+        self.hits = self.disk_hits = self.misses = self.evictions = self.disk_evictions = 0
+        if db_path is not None: self._open_db(db_path)
+
+    def _open_db(self, db_path):
+        self._db = sqlite3.connect(db_path, timeout=30.0, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, value TEXT NOT NULL, last_used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        with self._db:
+            self._db.execute("DELETE FROM results WHERE fingerprint != ?", (self.fingerprint,))
+
+    def key(self, frame, **options):
+        """Cache key for a frame and the pipeline options that affect its result (profile, crop_roi, ...)."""
+        option_text = ','.join(f'{k}={options[k]}' for k in sorted(options))
+        return f'{self.fingerprint}:{option_text}:{frame_digest(frame)}'
+
+    def get(self, key):
+        """Returns the cached value or None, promoting disk hits into memory."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            if self._db is not None:
+                row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    with self._db:
+                        self._db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+                    value = json.loads(row[0])
+                    self._remember(key, value)
+                    self.disk_hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, self.fingerprint, json.dumps(value), time.time()))
+                self._puts_since_trim += 1
+                if self._puts_since_trim >= 64: self._trim_db()
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _trim_db(self):
+        self._puts_since_trim = 0
+        (count,) = self._db.execute("SELECT COUNT(*) FROM results").fetchone()
+        if count > self.max_disk_entries:
+            with self._db:
+                self._db.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)", (count - self.max_disk_entries,))
+            self.disk_evictions += count - self.max_disk_entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                with self._db: self._db.execute("DELETE FROM results")
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'evictions': self.evictions, 'disk_evictions': self.disk_evictions,
+                'entries': len(self._entries), 'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0}
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._trim_db()
+                self._db.close()
+                self._db = None
@@ -0,0 +1,72 @@
+"""
+Parity check between full-frame and ROI-cropped feature extraction.
+
+Runs each image through preprocessing and segmentation once, extracts features both on the full
+300x300 frame (legacy) and on the coin's cropped bounding box (crop_roi=True), and reports which
+features differ and by how much. Models trained on full-frame features should keep crop_roi off
+unless only unchanged features are reported.
+
+Usage:
+    python roi_parity_check.py path/to/images [--tolerance 1e-9]
+"""
+import os
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import argparse
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from image_processing_pipeline import (DEFAULT_FEATURE_NAMES, ROI_MARGIN, circle_roi, compile_feature_layout, extract_feature_vector,
+                                       preprocess_denoise_normalize, segment_hough_circle)
+from offline_recognition import collect_image_paths
+
+
+def feature_pairs(paths, feature_names):
+    """Yields (full_frame_vector, cropped_vector, full_ms, cropped_ms) for every image with a detected coin."""
+    layout = compile_feature_layout(feature_names)
+    for path in paths:
+        frame = cv2.imread(path)
+        if frame is None: continue
+        frame = cv2.resize(frame, (300, 300), interpolation=cv2.INTER_AREA)
+        segmented, mask, circles = segment_hough_circle(preprocess_denoise_normalize(frame))
+        if circles is None: continue
+        start = time.perf_counter()
+        full = extract_feature_vector(segmented, mask, layout, frame)
+        full_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        roi = circle_roi(circles[0, 0], mask.shape, ROI_MARGIN)
+        cropped = extract_feature_vector(segmented[roi], mask[roi], layout, frame[roi])
+        yield full, cropped, full_ms, (time.perf_counter() - start) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report which features change when extraction is cropped to the coin ROI.")
+    parser.add_argument('inputs', nargs='+', help="Image files, directories or @file lists.")
+    parser.add_argument('--tolerance', type=float, default=1e-9, help="Relative difference below which a feature counts as unchanged.")
+    args = parser.parse_args(argv)
+
+    pairs = list(feature_pairs(collect_image_paths(args.inputs), DEFAULT_FEATURE_NAMES))
+    if not pairs:
+        print("No images with a detected coin.", file=sys.stderr)
+        return 1
+    full = np.array([p[0] for p in pairs]); cropped = np.array([p[1] for p in pairs])
+    abs_diff = np.abs(full - cropped)
+    rel_diff = abs_diff / np.maximum(np.maximum(np.abs(full), np.abs(cropped)), 1e-12)
+    changed = rel_diff.max(axis=0) > args.tolerance
+
+    print(f"Images with a detected coin: {len(pairs)}")
+    print(f"Extraction time: full frame {np.median([p[2] for p in pairs]):.1f} ms, cropped {np.median([p[3] for p in pairs]):.1f} ms (median)")
+    print(f"Changed features: {int(changed.sum())}/{len(DEFAULT_FEATURE_NAMES)}")
+    for i in np.flatnonzero(changed):
+        print(f"  {DEFAULT_FEATURE_NAMES[i]:<16} max abs diff {abs_diff[:, i].max():.6g}  max rel diff {rel_diff[:, i].max():.3%}  "
+              f"images affected {int((rel_diff[:, i] > args.tolerance).sum())}/{len(pairs)}")
+    unchanged = [DEFAULT_FEATURE_NAMES[i] for i in np.flatnonzero(~changed)]
+    print(f"Unchanged features: {', '.join(unchanged) if unchanged else 'none'}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
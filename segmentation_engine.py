@@ -0,0 +1,202 @@
+"""
+Coarse-to-fine Hough circle segmentation.
+
+PyramidHoughSegmenter.segment() is a drop-in replacement for segment_hough_circle that also reports whether
+the coin was where a tracked or coarse-to-fine search expected it. Run as a script, it compares the engine
+with the full search on a set of images and reports agreement and latency per search path.
+
+Usage:
+    python segmentation_engine.py path/to/images [--profile fast] [--sequence]
+"""
+import os
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import argparse
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from image_processing_pipeline import HOUGH_PARAMS, hough_blur, segment_with_circle
+
+# Search paths reported in PyramidHoughSegmenter.last_search
+TRACKED = 'tracked'  # The window around the previous circle gave the full search's circle
+PYRAMID = 'pyramid'  # A candidate from the downscaled level, refined at full resolution, gave the full search's circle
+FULL = 'full'        # Neither shortcut gave the full search's circle
+SEARCHES = (TRACKED, PYRAMID, FULL)
+BLUR_PAD = 4  # Half-width of hough_blur's 9x9 kernel
+
+
+class PyramidHoughSegmenter:
+    """
+    Finds the coin circle with the full search of segment_hough_circle and reports which shortcut, if any,
+    would have found the same circle:
+
+    - with a previous circle, HoughCircles runs on a crop around it, with the centre limited to
+      track_window pixels from the previous centre and the radius to at most the previous radius + track_window
+      (the lower bound stays the full search's minRadius, since raising it lets inner relief rings win);
+    - otherwise circles are detected on the pyramid level downscaled by 2**levels, and up to
+      max_candidates of them are refined at full resolution in a window of refine_margin coarse pixels.
+
+    A refined circle is one the full search would accept at that position, but not necessarily its first
+    choice: a stronger circle elsewhere in the frame (an inner relief ring, or the other side of a coin
+    squashed into an ellipse) wins the full search. Only the whole accumulator can tell, so a shortcut circle
+    is accepted only when it matches the full search's best circle, and the full search's circles are what
+    segment() returns. Results therefore always equal segment_hough_circle's, at the cost of the shortcut
+    searches on top of the full one. last_search (None when no circle was found) and last_latency_ms describe
+    the latest call; stats() gives counts and mean latency per path.
+    """
+    def __init__(self, levels=1, max_candidates=3, refine_margin=4, track_window=12, hough_params=HOUGH_PARAMS):
+        self.levels = levels
+        self.max_candidates = max_candidates
+        self.refine_margin = refine_margin
+        self.track_window = track_window
+        self.params = dict(hough_params)
+        # Smallest pixel step that is a whole number of accumulator cells (6 px for dp=1.2)
+        self._grid = next((step for step in range(1, 64) if abs(step / self.params['dp'] - round(step / self.params['dp'])) < 1e-9), 1)
+        self.last_search = None
+        self.last_latency_ms = 0.0
+        self._totals = {search: [0, 0.0] for search in SEARCHES + (None,)}
+
+    def segment(self, image, previous_circle=None):
+        """Returns (segmented, mask, circles), always identical to segment_hough_circle(image)."""
+        if image is None: return None, None, None
+        start = time.perf_counter()
+        circles, search = self._search(image, previous_circle)
+        self.last_search = search
+        self.last_latency_ms = (time.perf_counter() - start) * 1000
+        totals = self._totals[search]
+        totals[0] += 1; totals[1] += self.last_latency_ms
+        return segment_with_circle(image, circles)
+
+    def _search(self, image, previous_circle):
+        circles = cv2.HoughCircles(hough_blur(image), cv2.HOUGH_GRADIENT, **self.params)
+        if circles is None: return None, None
+        best = circles[0, 0]
+        if previous_circle is not None and self._matches(self._refine(image, previous_circle, self.track_window), best):
+            return circles, TRACKED
+        scale = 2 ** self.levels
+        for candidate in self._coarse_candidates(image, scale):
+            if self._matches(self._refine(image, candidate * scale, self.refine_margin * scale), best):
+                return circles, PYRAMID
+        return circles, FULL
+
+    @staticmethod
+    def _matches(circles, best):
+        """True when the shortcut's circle is the full search's best circle (up to float rounding)."""
+        return circles is not None and np.allclose(circles[0, 0], best, atol=0.5)
+
+    def _coarse_candidates(self, image, scale):
+        small = image
+        for _ in range(self.levels): small = cv2.pyrDown(small)
+        small = cv2.GaussianBlur(small, (5, 5), 1)  # hough_blur's sigma of 2, at half resolution after pyrDown's own smoothing
+        p = self.params
+        # Accumulator votes scale with the circumference, so the vote threshold shrinks with the image
+        circles = cv2.HoughCircles(small, cv2.HOUGH_GRADIENT, dp=1, minDist=p['minDist'] / scale, param1=p['param1'],
+                                   param2=max(1, p['param2'] / scale), minRadius=max(1, p['minRadius'] // scale),
+                                   maxRadius=-(-p['maxRadius'] // scale))
+        return [] if circles is None else circles[0, :self.max_candidates]
+
+    def _refine(self, image, circle, window):
+        """
+        Full-resolution search for the strongest circle within window of circle's centre and at most window
+        larger, or None. The crop keeps every edge pixel within max_radius of the allowed centres, minRadius
+        stays that of the full search and the crop origin sits on the accumulator grid, so the circle found is
+        one the full search would accept there. Whether it is the full search's first choice depends on the
+        rest of the frame, which the crop does not see.
+        """
+        x, y, r = (float(v) for v in circle)
+        p = self.params
+        min_radius, max_radius = p['minRadius'], min(p['maxRadius'], int(np.ceil(r + window)))
+        if min_radius > max_radius: return None
+        reach = window + max_radius + 1
+        height, width = image.shape[:2]
+        x0, y0 = max(0, int(x - reach)), max(0, int(y - reach))
+        x0, y0 = x0 - x0 % self._grid, y0 - y0 % self._grid
+        x1, y1 = min(width, int(np.ceil(x + reach)) + 1), min(height, int(np.ceil(y + reach)) + 1)
+        if x1 <= x0 or y1 <= y0: return None
+        # Blurring the crop plus the kernel's reach gives exactly the pixels of hough_blur(image) in the crop
+        px0, py0 = max(0, x0 - BLUR_PAD), max(0, y0 - BLUR_PAD)
+        blurred = hough_blur(image[py0:min(height, y1 + BLUR_PAD), px0:min(width, x1 + BLUR_PAD)])
+        found = cv2.HoughCircles(blurred[y0 - py0:y1 - py0, x0 - px0:x1 - px0], cv2.HOUGH_GRADIENT, dp=p['dp'], minDist=p['minDist'],
+                                 param1=p['param1'], param2=p['param2'], minRadius=min_radius, maxRadius=max_radius)
+        if found is None: return None
+        found[0, :, 0] += x0; found[0, :, 1] += y0
+        near = np.flatnonzero(np.hypot(found[0, :, 0] - x, found[0, :, 1] - y) <= window)
+        return found[:, near[:1]] if near.size else None
+
+    def stats(self):
+        """{search: {'count', 'mean_ms'}} per search path; key 'none' counts frames where no circle was found."""
+        return {search or 'none': {'count': count, 'mean_ms': total / count if count else 0.0}
+                for search, (count, total) in self._totals.items()}
+
+    def reset_stats(self):
+        self._totals = {search: [0, 0.0] for search in self._totals}
+
+
+def compare_with_full_search(grays, segmenter, tracked=False):
+    """Runs every preprocessed frame through segment_hough_circle and the engine. Returns one row per frame."""
+    rows = []
+    previous = None
+    for gray in grays:
+        start = time.perf_counter()
+        reference = cv2.HoughCircles(hough_blur(gray), cv2.HOUGH_GRADIENT, **HOUGH_PARAMS)
+        reference_ms = (time.perf_counter() - start) * 1000
+        _, _, circles = segmenter.segment(gray, previous if tracked else None)
+        previous = None if circles is None else circles[0, 0]
+        row = {'reference_ms': reference_ms, 'engine_ms': segmenter.last_latency_ms, 'search': segmenter.last_search,
+               'reference_found': reference is not None, 'engine_found': circles is not None, 'center_error': None, 'radius_error': None}
+        if reference is not None and circles is not None:
+            (rx, ry, rr), (x, y, r) = reference[0, 0], circles[0, 0]
+            row['center_error'], row['radius_error'] = float(np.hypot(x - rx, y - ry)), float(abs(r - rr))
+        rows.append(row)
+    return rows
+
+
+def summarize(rows, stats):
+    n = len(rows)
+    reference_ms = np.array([r['reference_ms'] for r in rows]); engine_ms = np.array([r['engine_ms'] for r in rows])
+    both = [r for r in rows if r['center_error'] is not None]
+    print(f"Frames compared: {n}")
+    print(f"Latency     full: median {np.median(reference_ms):6.2f} ms, p95 {np.percentile(reference_ms, 95):6.2f} ms")
+    print(f"Latency   engine: median {np.median(engine_ms):6.2f} ms, p95 {np.percentile(engine_ms, 95):6.2f} ms")
+    print(f"Speedup (median): {np.median(reference_ms) / np.median(engine_ms):.2f}x")
+    print(f"Detection agreement: {sum(r['reference_found'] == r['engine_found'] for r in rows)}/{n}")
+    if both:
+        centre = np.array([r['center_error'] for r in both]); radius = np.array([r['radius_error'] for r in both])
+        same = sum(r['center_error'] <= 6 and r['radius_error'] <= 6 for r in both)
+        print(f"Same circle (within 6 px): {same}/{len(both)}; centre error median {np.median(centre):.1f} px, "
+              f"radius error median {np.median(radius):.1f} px")
+    for search, s in stats.items():
+        print(f"  {search:>8}: {s['count']:4d} frames, mean {s['mean_ms']:6.2f} ms")
+
+
+def main(argv=None):
+    from image_processing_pipeline import PREPROCESS_PROFILES, preprocess_denoise_normalize
+    from offline_recognition import collect_image_paths
+    parser = argparse.ArgumentParser(description="Compare coarse-to-fine Hough segmentation with the full search.")
+    parser.add_argument('inputs', nargs='+', help="Image files, directories or @file lists.")
+    parser.add_argument('--profile', choices=PREPROCESS_PROFILES, default='fast', help="Preprocessing profile (default fast, as in live recognition).")
+    parser.add_argument('--sequence', action='store_true', help="Treat the images as consecutive frames and track the previous circle.")
+    parser.add_argument('--levels', type=int, default=1, help="Pyramid levels to downscale for the coarse search (default 1).")
+    args = parser.parse_args(argv)
+
+    grays = []
+    for path in collect_image_paths(args.inputs):
+        frame = cv2.imread(path)
+        if frame is None:
+            print(f"Skipping unreadable image: {path}", file=sys.stderr)
+            continue
+        gray = preprocess_denoise_normalize(cv2.resize(frame, (300, 300), interpolation=cv2.INTER_AREA), args.profile)
+        if gray is not None: grays.append(gray)
+    if not grays:
+        print("No readable images found.", file=sys.stderr)
+        return 1
+    segmenter = PyramidHoughSegmenter(levels=args.levels)
+    summarize(compare_with_full_search(grays, segmenter, tracked=args.sequence), segmenter.stats())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
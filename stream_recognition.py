@@ -0,0 +1,444 @@
+"""
+Headless streaming recognition over video files and network streams (MJPEG such as DroidCam's
+'http://<ip>:4747/video', RTSP, or anything else cv2.VideoCapture opens).
+
+Frames flow through generator stages connected by bounded queues:
+    decode -> resize -> preprocess -> segment -> features -> classify -> sink
+Every stage runs on its own thread. The heavy stages fan frames out to a thread pool (OpenCV and NumPy
+release the GIL in their kernels) and pass them on in order, and classify scores whatever has queued up
+in one batched call. A full queue blocks the stage feeding it, so files are decoded only as fast as they
+are recognized; live streams instead drop their oldest undelivered frame, so results stay current.
+
+Usage:
+    python stream_recognition.py run conveyor.mp4 -o results.csv [--every 2] [--max-fps 10] [-w 4]
+    python stream_recognition.py run http://192.168.1.20:4747/video -o results.jsonl --duration 60
+    python stream_recognition.py serve-mjpeg conveyor.mp4 [--port 4747] [--fps 15]
+"""
+import os
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import argparse
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from image_processing_pipeline import (PREPROCESS_PROFILES, classify_batch_rows, compile_feature_layout, extract_frame_features,
+                                       preprocess_frame, resize_frame, segment_frame)
+from offline_recognition import ResultWriter
+from pipeline_profiler import PROFILER
+
+STREAM_RESULT_FIELDS = ['frame_index', 'timestamp_ms', 'coin_type', 'coin_side', 'type_confidence', 'side_confidence', 'error']
+_END = object()
+
+
+def is_live_source(source):
+    """Camera indices and URLs are live; anything else is treated as a file that can be read at our own pace."""
+    return isinstance(source, int) or '://' in str(source)
+
+
+def decode_frames(source, every=1, max_fps=None, max_frames=None, duration=None):
+    """
+    Yields {'index', 'timestamp_ms', 'frame'} items from a cv2.VideoCapture source. Only every `every`-th
+    frame is kept and, with max_fps, at most that many frames per second of stream time (wall-clock time
+    for live sources); skipped frames are grabbed but never decoded. Stops after max_frames kept frames,
+    duration seconds of stream time or at the end of the source. Invalid every/max_fps raise ValueError
+    right away rather than on the thread that iterates the frames.
+    """
+    if every < 1: raise ValueError(f"every must be at least 1, got {every}")
+    if max_fps is not None and max_fps <= 0: raise ValueError(f"max_fps must be positive, got {max_fps}")
+    return _decode_frames(source, every, max_fps, max_frames, duration)
+
+
+def _decode_frames(source, every, max_fps, max_frames, duration):
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise RuntimeError(f"Could not open video source: {source}")
+    live = is_live_source(source)
+    start = time.perf_counter()
+    next_sample_ms = 0.0
+    kept = index = 0
+    try:
+        while capture.grab():
+            timestamp_ms = (time.perf_counter() - start) * 1000 if live else capture.get(cv2.CAP_PROP_POS_MSEC)
+            index += 1
+            if duration is not None and timestamp_ms > duration * 1000: return
+            if (index - 1) % every: continue
+            if max_fps:
+                if timestamp_ms < next_sample_ms: continue
+                next_sample_ms += 1000 / max_fps
+                if next_sample_ms <= timestamp_ms:  # Fell behind (e.g. after a stall): restart the schedule instead of catching up
+                    next_sample_ms = timestamp_ms + 1000 / max_fps
+            ok, frame = capture.retrieve()
+            if not ok or frame is None: continue
+            yield {'index': index - 1, 'timestamp_ms': timestamp_ms, 'frame': frame}
+            kept += 1
+            if max_frames is not None and kept >= max_frames: return
+    finally:
+        capture.release()
+
+
+# Per-frame stages, built from the shared pipeline steps. Items are dicts; once a stage stores a 'result'
+# (an error), later stages pass the item through.
+
+def resize_stage(item):
+    item['frame'] = resize_frame(item['frame'], item['timings'], copy=False)  # Decoded frames belong to the item
+    return item
+
+
+def preprocess_stage(item, profile='accurate'):
+    if 'result' in item: return item
+    item['gray'], error_result = preprocess_frame(item['frame'], profile, item['timings'])
+    if error_result is not None: item['result'] = error_result
+    return item
+
+
+def segment_stage(item):
+    if 'result' in item: return item
+    item['segmented'], item['mask'], item['circles'], error_result = segment_frame(item.pop('gray'), item['timings'])
+    if error_result is not None: item['result'] = error_result
+    return item
+
+
+def features_stage(item, layout, crop_roi=False):
+    if 'result' not in item:
+        item['features'] = extract_frame_features(item['segmented'], item['mask'], item['circles'], item['frame'], layout, crop_roi,
+                                                  timings=item['timings'])
+    return _drop_images(item)
+
+
+def classify_stage(items, scaler, type_clf, side_clf):
+    """Batch stage: scores every item that reached it with features in one classifier call."""
+    results = [item.get('result') for item in items]
+    valid = [i for i, result in enumerate(results) if result is None]
+    if valid:
+        classify_batch_rows(results, valid, np.stack([items[i].pop('features') for i in valid]), scaler, type_clf, side_clf,
+                             [item['timings'] for item in items])
+    for item, result in zip(items, results):
+        item['result'] = result
+    return items
+
+
+def _drop_images(item):
+    for key in ('frame', 'segmented', 'mask'): item.pop(key, None)
+    return item
+
+
+class Stage:
+    """
+    One pipeline stage. fn maps an item to an item; with batch_size it maps a list of up to batch_size
+    items (whatever is queued when the stage becomes free) to a list. workers > 1 runs items on a
+    thread pool with at most 2 * workers in flight and emits them in input order.
+    """
+    def __init__(self, name, fn, workers=1, batch_size=None):
+        self.name, self.fn, self.workers, self.batch_size = name, fn, max(1, workers), batch_size
+        self.items = 0
+        self.busy_ms = 0.0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+
+    def _timed(self, fn, arg):
+        start = time.perf_counter()
+        out = fn(arg)
+        with self._lock: self.busy_ms += (time.perf_counter() - start) * 1000
+        return out
+
+    def run(self, items):
+        """Generator applying the stage to an iterable of items (or of batches, with batch_size)."""
+        if self.batch_size:
+            for batch in items:
+                self.items += len(batch)
+                yield from self._timed(self.fn, batch)
+        elif self.workers == 1:
+            for item in items:
+                self.items += 1
+                yield self._timed(self.fn, item)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'stream-{self.name}') as pool:
+                pending = deque()
+                for item in items:
+                    self.items += 1
+                    pending.append(pool.submit(self._timed, self.fn, item))
+                    if len(pending) >= 2 * self.workers: yield pending.popleft().result()
+                while pending: yield pending.popleft().result()
+
+
+class StreamPipeline:
+    """
+    Connects a source iterator and a list of Stages with bounded queues of queue_size items, one thread
+    per stage. Iterating the pipeline yields the last stage's items in source order. With drop_oldest,
+    the source never blocks: when the first queue is full its oldest frame is discarded and counted in
+    frames_dropped (for live streams). Leaving the iteration early stops every thread.
+    """
+    def __init__(self, source, stages, queue_size=8, drop_oldest=False):
+        self.source, self.stages, self.queue_size, self.drop_oldest = source, stages, queue_size, drop_oldest
+        self.frames_in = 0
+        self.frames_dropped = 0
+        self._stop = threading.Event()
+        self._error = None
+
+    def __iter__(self):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed_source, args=(queues[0],), name='stream-decode', daemon=True)]
+        threads += [threading.Thread(target=self._feed_stage, args=(stage, queues[i], queues[i + 1]), name=f'stream-{stage.name}', daemon=True)
+                    for i, stage in enumerate(self.stages)]
+        for thread in threads: thread.start()
+        try:
+            for item in self._queue_items(queues[-1]): yield item
+            if self._error is not None: raise self._error
+        finally:
+            self._stop.set()
+            for q in queues:  # Unblock producers waiting on a full queue
+                while not q.empty(): q.get_nowait()
+            for thread in threads: thread.join(timeout=2.0)
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        """Next item from q, or _END once the pipeline is stopping."""
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set(): return _END
+
+    def _queue_items(self, q):
+        while True:
+            item = self._get(q)
+            if item is _END: return
+            yield item
+
+    def _queue_batches(self, q, batch_size, stage):
+        """Blocks for one item, then takes whatever else is already queued, up to batch_size."""
+        while True:
+            item = self._get(q)
+            if item is _END: return
+            batch = [item]
+            stage.max_queue_depth = max(stage.max_queue_depth, q.qsize() + 1)
+            while len(batch) < batch_size:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _END:
+                    yield batch
+                    return
+                batch.append(item)
+            yield batch
+
+    def _feed_source(self, q):
+        try:
+            for item in self.source:
+                if self._stop.is_set(): return
+                item['timings'] = PROFILER.new_frame()
+                if item['timings'] is not None: item['timings']['total'] = 0.0  # Set to the end-to-end latency at the sink
+                item['started'] = time.perf_counter()
+                self.frames_in += 1
+                if self.drop_oldest:
+                    while True:
+                        try:
+                            q.put_nowait(item)
+                            break
+                        except queue.Full:
+                            try:
+                                q.get_nowait()
+                                self.frames_dropped += 1
+                            except queue.Empty:
+                                pass
+                elif not self._put(q, item):
+                    return
+        except Exception as e:
+            self._error = e
+        finally:
+            if hasattr(self.source, 'close'): self.source.close()
+            self._put(q, _END)
+
+    def _feed_stage(self, stage, in_q, out_q):
+        items = self._queue_batches(in_q, stage.batch_size, stage) if stage.batch_size else self._tracked_items(in_q, stage)
+        try:
+            for item in stage.run(items):
+                if not self._put(out_q, item): return
+        except Exception as e:
+            self._error = self._error or e
+            self._stop.set()
+        finally:
+            self._put(out_q, _END)
+
+    def _tracked_items(self, q, stage):
+        for item in self._queue_items(q):
+            stage.max_queue_depth = max(stage.max_queue_depth, q.qsize() + 1)
+            yield item
+
+    def stats(self):
+        """Frames taken from the source and dropped, plus items, busy time and peak input queue depth per stage."""
+        return {'frames_in': self.frames_in, 'frames_dropped': self.frames_dropped,
+                'stages': {s.name: {'items': s.items, 'busy_ms': s.busy_ms, 'max_queue_depth': s.max_queue_depth} for s in self.stages}}
+
+
+def build_recognition_stages(assets, profile='accurate', crop_roi=False, workers=2, batch_size=16):
+    """The resize -> preprocess -> segment -> features -> classify stages for the given prediction assets."""
+    scaler, feature_names, type_clf, side_clf = assets
+    layout = compile_feature_layout(feature_names)
+    return [Stage('resize', resize_stage),
+            Stage('preprocess', partial(preprocess_stage, profile=profile), workers),
+            Stage('segment', segment_stage, workers),
+            Stage('features', partial(features_stage, layout=layout, crop_roi=crop_roi), workers),
+            Stage('classify', partial(classify_stage, scaler=scaler, type_clf=type_clf, side_clf=side_clf), batch_size=batch_size)]
+
+
+def iter_stream_results(source, assets, every=1, max_fps=None, max_frames=None, duration=None, profile='accurate', crop_roi=False,
+                        workers=2, batch_size=16, queue_size=8, drop_oldest=None, pipeline=None):
+    """
+    Runs the streaming pipeline over a video source and yields one STREAM_RESULT_FIELDS record per kept
+    frame, in frame order. drop_oldest defaults to True for live sources. Pass a list as pipeline to
+    receive the StreamPipeline (for its stats()).
+    """
+    drop_oldest = is_live_source(source) if drop_oldest is None else drop_oldest
+    stream = StreamPipeline(decode_frames(source, every, max_fps, max_frames, duration), build_recognition_stages(assets, profile, crop_roi, workers, batch_size),
+                            queue_size=queue_size, drop_oldest=drop_oldest)
+    if pipeline is not None: pipeline.append(stream)
+    for item in stream:
+        if item['timings'] is not None:
+            item['timings']['total'] = (time.perf_counter() - item['started']) * 1000
+            PROFILER.record(item['timings'])
+        result = item['result']
+        yield {'frame_index': item['index'], 'timestamp_ms': round(item['timestamp_ms'], 1), **{k: result.get(k) for k in STREAM_RESULT_FIELDS[2:]}}
+
+
+class _MJPEGHandler(BaseHTTPRequestHandler):
+    boundary = 'frame'
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/video':
+            self.send_error(404)
+            return
+        capture = cv2.VideoCapture(self.server.video_source)
+        fps = self.server.fps or capture.get(cv2.CAP_PROP_FPS) or 15.0
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={self.boundary}')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        next_frame = time.perf_counter()
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    if not self.server.loop: return
+                    capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                data = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.server.quality])[1].tobytes()
+                self.wfile.write(f'--{self.boundary}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(data)}\r\n\r\n'.encode() + data + b'\r\n')
+                next_frame += 1 / fps
+                time.sleep(max(0.0, next_frame - time.perf_counter()))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            capture.release()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_mjpeg(video_source, host='127.0.0.1', port=4747, fps=None, loop=True, quality=80):
+    """
+    Serves a video file as a DroidCam-style MJPEG stream at http://host:port/video, paced at fps (default:
+    the file's own rate), for testing stream ingestion without a phone. Returns the server; call
+    serve_forever() on it, or run that on a thread and shutdown() when done.
+    """
+    server = ThreadingHTTPServer((host, port), _MJPEGHandler)
+    server.daemon_threads = True
+    server.video_source, server.fps, server.loop, server.quality = video_source, fps, loop, quality
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Streaming coin recognition over video files and network streams.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help="Recognize coins in a video file or stream.")
+    run.add_argument('source', help="Video file, stream URL (http://<ip>:4747/video, rtsp://...) or camera index.")
+    run.add_argument('-o', '--output', default='-', help="Output file (.csv or .jsonl). Defaults to stdout.")
+    run.add_argument('--every', type=int, default=1, help="Keep every N-th frame (default 1).")
+    run.add_argument('--max-fps', type=float, default=None, help="Keep at most this many frames per second of stream time.")
+    run.add_argument('--max-frames', type=int, default=None, help="Stop after this many kept frames.")
+    run.add_argument('--duration', type=float, default=None, help="Stop after this many seconds of stream time.")
+    run.add_argument('--profile', choices=PREPROCESS_PROFILES, default='accurate', help="Preprocessing profile (default accurate).")
+    run.add_argument('--crop-roi', action='store_true', help="Extract features on the coin's bounding box (only for models trained that way).")
+    run.add_argument('-w', '--workers', type=int, default=2, help="Worker threads for each of preprocess, segment and features (default 2).")
+    run.add_argument('--batch-size', type=int, default=16, help="Most frames scored by one classifier call (default 16).")
+    run.add_argument('--queue-size', type=int, default=8, help="Capacity of the queue in front of each stage (default 8).")
+    drop = run.add_mutually_exclusive_group()
+    drop.add_argument('--drop-frames', dest='drop_oldest', action='store_true', default=None, help="Drop the oldest frame when recognition falls behind (default for live sources).")
+    drop.add_argument('--no-drop-frames', dest='drop_oldest', action='store_false', help="Never drop frames; decoding waits for recognition (default for files).")
+    serve = commands.add_parser('serve-mjpeg', help="Serve a video file as a local DroidCam-style MJPEG stream.")
+    serve.add_argument('video', help="Video file to stream.")
+    serve.add_argument('--host', default='127.0.0.1', help="Interface to bind (default 127.0.0.1).")
+    serve.add_argument('--port', type=int, default=4747, help="Port (default 4747, as DroidCam).")
+    serve.add_argument('--fps', type=float, default=None, help="Frame rate (default: the file's own).")
+    serve.add_argument('--once', action='store_true', help="End the stream at the end of the file instead of looping.")
+    args = parser.parse_args(argv)
+    if args.command == 'run' and args.every < 1: parser.error("--every must be at least 1")
+    if args.command == 'run' and args.max_fps is not None and args.max_fps <= 0: parser.error("--max-fps must be positive")
+
+    if args.command == 'serve-mjpeg':
+        server = serve_mjpeg(args.video, args.host, args.port, args.fps, loop=not args.once)
+        print(f"Serving {args.video} at http://{args.host}:{args.port}/video (Ctrl+C to stop).", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+
+    from model_loader import load_prediction_assets
+    assets = load_prediction_assets()
+    if not all(a is not None for a in assets):
+        print("Prediction assets failed to load.", file=sys.stderr)
+        return 1
+    source = int(args.source) if args.source.isdigit() else args.source
+    fmt = 'jsonl' if args.output.endswith(('.jsonl', '.json')) else 'csv'
+    stream = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    pipeline = []
+    start = time.perf_counter()
+    processed = errors = 0
+    try:
+        writer = ResultWriter(stream, fmt, STREAM_RESULT_FIELDS)
+        for record in iter_stream_results(source, assets, args.every, args.max_fps, args.max_frames, args.duration, args.profile, args.crop_roi,
+                                          args.workers, args.batch_size, args.queue_size, args.drop_oldest, pipeline):
+            writer.write(record)
+            processed += 1
+            errors += record['error'] is not None
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if stream is not sys.stdout: stream.close()
+
+    elapsed = time.perf_counter() - start
+    stats = pipeline[0].stats()
+    print(f"Recognized {processed} frames in {elapsed:.2f}s ({processed / elapsed:.1f} frames/s, {errors} with errors, "
+          f"{stats['frames_dropped']} dropped).", file=sys.stderr)
+    for name, s in stats['stages'].items():
+        print(f"  {name:<10} {s['items']:6d} items, busy {s['busy_ms'] / max(1, s['items']):7.2f} ms/item, peak queue {s['max_queue_depth']}", file=sys.stderr)
+    if PROFILER.enabled: print(PROFILER.summary_text(), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
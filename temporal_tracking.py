@@ -0,0 +1,152 @@
+import cv2
+import numpy as np
+from pipeline_profiler import PROFILER, stage_timer
+from image_processing_pipeline import (preprocess_denoise_normalize, extract_frame_features, compile_feature_layout, resize_frame,
+                                       pipeline_error_result, predict_feature_probabilities, results_from_probabilities, draw_detected_circles)
+from segmentation_engine import PyramidHoughSegmenter
+
+# Decisions reported in CoinTracker.last_decision
+REUSED = 'reused'          # Scene static: cached prediction returned, nothing recomputed
+TRACKED = 'tracked'        # Coin still in place: segmentation re-run, cached prediction kept
+SMOOTHED = 'smoothed'      # Same coin moved: recomputed and blended into the running average
+RECOMPUTED = 'recomputed'  # Scene change: recomputed from scratch, history reset
+
+
+class CoinTracker:
+    """
+    Temporal stage for live recognition. Tracks the coin circle across frames with PyramidHoughSegmenter, which
+    finds the same circle as the full search and reports whether the window around the previous position
+    would have found it too (segmenter.stats() gives the counts and detection latency), and only re-runs feature extraction and the forests when the scene actually changes:
+
+    - a cheap frame difference on a small thumbnail below still_threshold reuses the cached prediction outright;
+    - otherwise the frame is segmented, and if the circle stayed within center/radius tolerance and the
+      difference is below motion_threshold, the cached prediction is kept;
+    - if the circle moved but is plausibly the same coin, features are recomputed and the class probabilities
+      are blended into an exponential moving average (ema_alpha), which stops labels flickering;
+    - anything else (new coin, coin lost, large difference) recomputes from scratch and resets the average.
+
+    process() returns (results, visualized_frame) like run_recognition_pipeline; with visualize=False nothing is
+    drawn and visualized_frame is None. circles holds the circles found for the latest frame (None if no coin).
+    It is not thread-safe; call reset() from another thread only to request a reset, which is applied before
+    the next frame.
+    """
+    def __init__(self, scaler, type_clf, side_clf, feature_names, profile='fast', thumbnail_size=64,
+                 still_threshold=2.0, motion_threshold=8.0, center_tolerance=6.0, radius_tolerance=6.0,
+                 same_coin_distance=0.5, ema_alpha=0.4, crop_roi=False, segmenter=None, visualize=True):
+        self.scaler, self.type_clf, self.side_clf = scaler, type_clf, side_clf
+        self.segmenter = segmenter or PyramidHoughSegmenter()
+        self.layout = compile_feature_layout(feature_names)
+        self.profile = profile
+        self.thumbnail_size = thumbnail_size
+        self.still_threshold = still_threshold
+        self.motion_threshold = motion_threshold
+        self.center_tolerance = center_tolerance
+        self.radius_tolerance = radius_tolerance
+        self.same_coin_distance = same_coin_distance
+        self.ema_alpha = ema_alpha
+        self.crop_roi = crop_roi
+        self.visualize = visualize
+        self.feature_vector = self.layout.new_vector()
+        self.counters = {REUSED: 0, TRACKED: 0, SMOOTHED: 0, RECOMPUTED: 0}
+        self.last_decision = None
+        self._reset_requested = False
+        self._clear_state()
+
+    @property
+    def circles(self):
+        return self._circles
+
+    def reset(self):
+        self._reset_requested = True
+
+    def _clear_state(self):
+        self._thumbnail = None
+        self._circle = None
+        self._circles = None
+        self._type_ema = None
+        self._side_ema = None
+        self._results = None
+
+    def _frame_difference(self, frame_bgr):
+        gray = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(gray, (self.thumbnail_size, self.thumbnail_size), interpolation=cv2.INTER_AREA)
+        diff = float('inf') if self._thumbnail is None else float(cv2.mean(cv2.absdiff(thumbnail, self._thumbnail))[0])
+        return thumbnail, diff
+
+    def _circle_change(self, circle):
+        """Returns 'still', 'moved' (plausibly the same coin) or 'changed' relative to the tracked circle."""
+        if self._circle is None: return 'changed'
+        (x0, y0, r0), (x, y, r) = self._circle, circle
+        shift = np.hypot(x - x0, y - y0)
+        if shift <= self.center_tolerance and abs(r - r0) <= self.radius_tolerance: return 'still'
+        if shift <= self.same_coin_distance * r0 and abs(r - r0) <= self.same_coin_distance * r0: return 'moved'
+        return 'changed'
+
+    def process(self, frame_bgr):
+        timings = PROFILER.new_frame()
+        with stage_timer(timings, 'total'):
+            results, visualized_frame = self._process(frame_bgr, timings)
+            # _process leaves the circles to show in self._circles and hands back its resized frame, drawn on only now
+            # that every feature has been read from it
+            if visualized_frame is None or not self.visualize: visualized_frame = None
+            else: draw_detected_circles(visualized_frame, self._circles)
+        if timings is not None:
+            results['timings'] = timings
+            PROFILER.record(timings)
+        return results, visualized_frame
+
+    def _process(self, frame_bgr, timings):
+        if frame_bgr is None:
+            return {'error': "Input frame is None."}, None
+        if self._reset_requested:
+            self._reset_requested = False
+            self._clear_state()
+
+        frame_bgr = visualized_frame = resize_frame(frame_bgr, copy=self.visualize)
+        thumbnail, diff = self._frame_difference(frame_bgr)
+
+        if self._results is not None and diff <= self.still_threshold:
+            return self._decide(REUSED, thumbnail), visualized_frame
+
+        with stage_timer(timings, 'preprocess'):
+            preprocessed_gray = preprocess_denoise_normalize(frame_bgr, self.profile)
+        with stage_timer(timings, 'segment'):
+            segmented_gray, mask, detected_circles = self.segmenter.segment(preprocessed_gray, self._circle)
+        if detected_circles is None:
+            self._clear_state()
+            self._thumbnail = thumbnail
+            self.last_decision = None
+            return {'error': "No coin detected"}, visualized_frame
+
+        circle = tuple(float(v) for v in detected_circles[0, 0])
+        change = self._circle_change(circle)
+        self._circle, self._circles = circle, detected_circles
+        if self._results is not None and change == 'still' and diff <= self.motion_threshold:
+            return self._decide(TRACKED, thumbnail), visualized_frame
+
+        extract_frame_features(segmented_gray, mask, detected_circles, frame_bgr, self.layout, self.crop_roi, self.feature_vector, timings)
+        if self.feature_vector.shape[0] != self.scaler.n_features_in_:
+            return pipeline_error_result(f"Feature shape mismatch. Expected {self.scaler.n_features_in_}."), visualized_frame
+        try:
+            with stage_timer(timings, 'classify'):
+                type_probas, side_probas = predict_feature_probabilities(self.feature_vector.reshape(1, -1), self.scaler, self.type_clf, self.side_clf)
+        except Exception as e:
+            return pipeline_error_result(f"Prediction failed: {e}"), visualized_frame
+
+        if change == 'changed' or self._type_ema is None:
+            decision = RECOMPUTED
+            self._type_ema, self._side_ema = type_probas, side_probas
+        else:
+            decision = SMOOTHED
+            a = self.ema_alpha
+            self._type_ema = a * type_probas + (1 - a) * self._type_ema
+            self._side_ema = a * side_probas + (1 - a) * self._side_ema
+        self._results = results_from_probabilities(self._type_ema, self._side_ema, self.type_clf, self.side_clf)[0]
+        return self._decide(decision, thumbnail), visualized_frame
+
+    def _decide(self, decision, thumbnail):
+        # The reference thumbnail only advances on recompute, so slow drift still adds up to a scene change.
+        if decision in (SMOOTHED, RECOMPUTED) or self._thumbnail is None: self._thumbnail = thumbnail
+        self.last_decision = decision
+        self.counters[decision] += 1
+        return dict(self._results)